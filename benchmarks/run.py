@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks of the spec aggregation and of the proxy hot path.
+
+Synthetic microservices are served by a local stub server. Each stage is run several
+times, and its throughput, latency percentiles and peak memory are reported.
+Results can be saved in JSON to compare releases:
+
+    python benchmarks/run.py --apis 20 --paths 50 --output before.json
+"""
+
+from __future__ import print_function
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+import flask
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from swagger_aggregator import SwaggerAggregator  # noqa: E402
+from synthetic import StubServer  # noqa: E402
+from synthetic import make_config  # noqa: E402
+from synthetic import make_doc  # noqa: E402
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def get_percentile(samples, percentile):
+    """Get a percentile of sorted samples, by nearest rank.
+
+    Args:
+        samples: sorted list of samples.
+        percentile: percentile between 0 and 100.
+
+    Returns:
+        The percentile.
+    """
+    rank = int(round(percentile / 100. * (len(samples) - 1)))
+    return samples[rank]
+
+
+def get_stats(name, durations, wall_time=None, peak_memory=None):
+    """Get the stats of a stage.
+
+    Args:
+        name: name of the stage.
+        durations: duration of each run, in seconds.
+        wall_time: total time of the runs when they are concurrent, defaults to the sum of the durations.
+        peak_memory: peak memory allocated by a run, in bytes.
+
+    Returns:
+        Dict of stats, latencies in milliseconds.
+    """
+    durations = sorted(durations)
+    if wall_time is None:
+        wall_time = sum(durations)
+    return {
+        'name': name,
+        'runs': len(durations),
+        'throughput': len(durations) / wall_time if wall_time else None,
+        'mean_ms': sum(durations) / len(durations) * 1000,
+        'p50_ms': get_percentile(durations, 50) * 1000,
+        'p90_ms': get_percentile(durations, 90) * 1000,
+        'p99_ms': get_percentile(durations, 99) * 1000,
+        'peak_memory_kb': peak_memory / 1024. if peak_memory is not None else None
+    }
+
+
+def measure_peak_memory(func):
+    """Get the peak memory allocated while calling a function.
+
+    Args:
+        func: function called without arguments.
+
+    Returns:
+        Peak memory in bytes, None if tracemalloc is not available.
+    """
+    if tracemalloc is None:
+        func()
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench(name, func, repeat, setup=None):
+    """Benchmark a function.
+
+    Args:
+        name: name of the stage.
+        func: function benchmarked, called with the result of setup.
+        repeat: number of timed runs.
+        setup: function called without arguments before each run, not timed.
+
+    Returns:
+        Stats of the stage.
+    """
+    durations = []
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = timer()
+        func(arg)
+        durations.append(timer() - start)
+    arg = setup() if setup is not None else None
+    return get_stats(name, durations, peak_memory=measure_peak_memory(lambda: func(arg)))
+
+
+def bench_aggregation(args, config_file, stub_url):
+    """Benchmark the stages of the aggregation.
+
+    Args:
+        args: command line arguments.
+        config_file: path of the aggregation config.
+        stub_url: url of the stub server.
+
+    Returns:
+        List of stats.
+    """
+    agg = SwaggerAggregator(config_file, stub_url, timeout=10)
+    swagger_apis = agg.get_aggregate_swagger()
+
+    def new_swagger():
+        return {'definitions': {}, 'paths': {}}
+
+    def fetch_all():  # Only the missing apis are fetched
+        agg.swagger_apis = {}
+
+    merged = new_swagger()
+    agg.merge_aggregates(merged, swagger_apis)
+
+    return [
+        bench('get_aggregate_swagger', lambda _: agg.get_aggregate_swagger(), args.repeat, setup=fetch_all),
+        bench('merge_aggregates', lambda swagger: agg.merge_aggregates(swagger, swagger_apis), args.repeat,
+              setup=new_swagger),
+        bench('exclude_paths', lambda _: agg.exclude_paths(merged), args.repeat),
+        bench('generate_swagger_json', lambda _: agg.generate_swagger_json(), args.repeat)
+    ]
+
+
+def bench_proxy(args, config_file, stub_url):
+    """Benchmark the operation functions and the filtering of the responses.
+
+    Args:
+        args: command line arguments.
+        config_file: path of the aggregation config.
+        stub_url: url of the stub server.
+
+    Returns:
+        List of stats.
+    """
+    agg = SwaggerAggregator(config_file, stub_url, timeout=10)
+    agg.generate_swagger_json()
+    app = flask.Flask(__name__)
+
+    # Item and array GET operations
+    item_operations = sorted((op for op in agg.operations.values() if op.action == 'get' and '{id}' in op.path),
+                             key=lambda op: op.name)
+    array_operations = sorted((op for op in agg.operations.values() if op.action == 'get' and '{id}' not in op.path),
+                              key=lambda op: op.name)
+
+    def call(operation):
+        """Call an operation function like connexion would, and read the whole response."""
+        kwargs = {'id': '1'} if '{id}' in operation.path else {}
+        start = timer()
+        with app.test_request_context(operation.path.replace('{id}', '1'), method='GET'):
+            result = operation.func(**kwargs)
+            if isinstance(result, flask.Response):
+                b''.join(result.response)
+            else:
+                json.dumps(result[0])
+        return timer() - start
+
+    stats = []
+    for name, ops in (('proxy_item', item_operations), ('proxy_array', array_operations)):
+        requests = [ops[i % len(ops)] for i in range(args.requests)]
+        for operation in ops[:args.concurrency]:  # Warm up the sessions
+            call(operation)
+        executor = ThreadPoolExecutor(max_workers=args.concurrency)
+        start = timer()
+        durations = list(executor.map(call, requests))
+        wall_time = timer() - start
+        executor.shutdown()
+        stats.append(get_stats(name, durations, wall_time, measure_peak_memory(lambda: call(ops[0]))))
+
+    # Filtering only, on copies of the docs of the stub server as they are filtered in place
+    doc = make_doc(0, args.definitions, args.properties)
+    plan = agg.get_filter_plan(item_operations[0].name, 200)
+    stats.append(bench('filter_definition', lambda d: agg.filter_definition(d, plan), args.requests,
+                       setup=lambda: copy.deepcopy(doc)))
+    array = [doc] * args.array_size
+    plan = agg.get_filter_plan(array_operations[0].name, 200)
+    stats.append(bench('filter_definition_array', lambda d: agg.filter_definition(d, plan), args.repeat,
+                       setup=lambda: copy.deepcopy(array)))
+    return stats
+
+
+def print_stats(stats):
+    """Print the stats as a table.
+
+    Args:
+        stats: list of stats.
+    """
+    columns = ('runs', 'throughput', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'peak_memory_kb')
+    print('{0:<24}'.format('stage') + ''.join('{0:>15}'.format(column) for column in columns))
+    for stat in stats:
+        print('{0:<24}'.format(stat['name']) +
+              ''.join('{0:>15.3f}'.format(stat[c]) if isinstance(stat[c], float) else '{0:>15}'.format(stat[c])
+                      for c in columns))
+
+
+def main(argv=None):
+    """Run the benchmarks."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--apis', type=int, default=5, help='number of apis')
+    parser.add_argument('--paths', type=int, default=20, help='number of collection paths per api')
+    parser.add_argument('--definitions', type=int, default=20, help='number of definitions per api')
+    parser.add_argument('--properties', type=int, default=10, help='number of properties per definition')
+    parser.add_argument('--array-size', type=int, default=50, help='number of items in the array responses')
+    parser.add_argument('--repeat', type=int, default=10, help='number of runs of the aggregation stages')
+    parser.add_argument('--requests', type=int, default=1000, help='number of proxied requests')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of concurrent proxied requests')
+    parser.add_argument('--skip-proxy', action='store_true', help='only benchmark the aggregation')
+    parser.add_argument('--output', help='file to save the results in, in JSON')
+    args = parser.parse_args(argv)
+
+    server = StubServer(args.apis, args.paths, args.definitions, args.properties, args.array_size)
+    server.start()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        config_file = os.path.join(tmp_dir, 'config.yaml')
+        with open(config_file, 'w') as f:
+            f.write(yaml.dump(make_config(args.apis, args.paths, args.definitions)))
+
+        stats = bench_aggregation(args, config_file, server.url)
+        if not args.skip_proxy:
+            stats += bench_proxy(args, config_file, server.url)
+    finally:
+        server.stop()
+        shutil.rmtree(tmp_dir)
+
+    print_stats(stats)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': sys.version, 'params': vars(args), 'stats': stats}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
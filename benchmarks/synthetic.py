@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+"""Synthetic microservices for the benchmarks.
+
+Specs, aggregation configs and response docs are generated from a few size parameters,
+and served by a local stub HTTP server.
+"""
+
+import json
+import re
+import threading
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+
+def get_definition_name(index):
+    """Get the name of the index-th definition of an api."""
+    return 'Item{0}'.format(index)
+
+
+def make_definition(index, nb_definitions, nb_properties):
+    """Make a definition with scalar properties and a reference to the next definition.
+
+    Args:
+        index: index of the definition.
+        nb_definitions: number of definitions of the api.
+        nb_properties: number of scalar properties of the definition.
+
+    Returns:
+        Swagger definition.
+    """
+    properties = {'id': {'type': 'integer'}, 'name': {'type': 'string'}}
+    for prop in range(nb_properties):
+        properties['field{0}'.format(prop)] = {'type': 'string'}
+    if nb_definitions > 1:
+        properties['next'] = {'$ref': '#/definitions/{0}'.format(get_definition_name((index + 1) % nb_definitions))}
+    return {'type': 'object', 'properties': properties}
+
+
+def make_spec(api, nb_paths, nb_definitions, nb_properties):
+    """Make the swagger spec of an api.
+
+    Each path is a collection (GET returning an array, POST) with an item path (GET, PUT, DELETE).
+
+    Args:
+        api: name of the api.
+        nb_paths: number of collection paths.
+        nb_definitions: number of definitions.
+        nb_properties: number of scalar properties of each definition.
+
+    Returns:
+        Swagger spec.
+    """
+    definitions = {get_definition_name(i): make_definition(i, nb_definitions, nb_properties)
+                   for i in range(nb_definitions)}
+    paths = {}
+    for index in range(nb_paths):
+        ref = {'$ref': '#/definitions/{0}'.format(get_definition_name(index % nb_definitions))}
+        body = [{'name': 'body', 'in': 'body', 'schema': ref}]
+        item_id = [{'name': 'id', 'in': 'path', 'type': 'integer', 'required': True}]
+        paths['/{0}/items{1}'.format(api, index)] = {
+            'get': {'responses': {'200': {'description': 'Items', 'schema': {'type': 'array', 'items': ref}}}},
+            'post': {'parameters': body, 'responses': {'201': {'description': 'Created', 'schema': ref}}}
+        }
+        paths['/{0}/items{1}/{{id}}'.format(api, index)] = {
+            'get': {'parameters': item_id, 'responses': {'200': {'description': 'Item', 'schema': ref}}},
+            'put': {'parameters': item_id + body, 'responses': {'200': {'description': 'Item', 'schema': ref}}},
+            'delete': {'parameters': item_id, 'responses': {'204': {'description': 'Deleted'}}}
+        }
+    return {'swagger': '2.0', 'info': {'title': api, 'version': '1.0'}, 'basePath': '/v1',
+            'definitions': definitions, 'paths': paths}
+
+
+def make_config(nb_apis, nb_paths, nb_definitions):
+    """Make the aggregation config of the synthetic apis.
+
+    A quarter of the item paths have their DELETE excluded, and every definition has a field excluded.
+
+    Args:
+        nb_apis: number of apis.
+        nb_paths: number of collection paths of each api.
+        nb_definitions: number of definitions of each api.
+
+    Returns:
+        Aggregation config, its only arg is stub_url.
+    """
+    apis = ['api{0}'.format(i) for i in range(nb_apis)]
+    return {
+        'args': 'stub_url',
+        'info': {'version': '1.0', 'title': 'Benchmark gateway'},
+        'basePath': '/v1',
+        'apis': {api: 'stub_url/{0}'.format(api) for api in apis},
+        'exclude_paths': ['DELETE /{0}/items{1}/{{id}}'.format(api, i)
+                          for api in apis for i in range(0, nb_paths, 4)],
+        'exclude_fields': {'{0}{1}'.format(api, get_definition_name(i)): ['field0']
+                           for api in apis for i in range(nb_definitions)},
+        'output': False
+    }
+
+
+def make_doc(index, nb_definitions, nb_properties, depth=2):
+    """Make a doc following a definition.
+
+    Args:
+        index: index of the definition.
+        nb_definitions: number of definitions of the api.
+        nb_properties: number of scalar properties of each definition.
+        depth: number of nested docs.
+
+    Returns:
+        Doc of the definition.
+    """
+    doc = {'id': index, 'name': 'item {0}'.format(index)}
+    for prop in range(nb_properties):
+        doc['field{0}'.format(prop)] = 'value {0}'.format(prop)
+    if depth and nb_definitions > 1:
+        doc['next'] = make_doc((index + 1) % nb_definitions, nb_definitions, nb_properties, depth - 1)
+    return doc
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve the specs and the docs of the synthetic apis."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # Headers and body are sent separately
+    path_re = re.compile(r'^/(?P<api>[^/]+)/(?:swagger\.json|(?P=api)/items(?P<index>\d+)(?P<item>/[^/?]+)?)')
+
+    def do_GET(self):
+        """Serve a spec, an item or an array of items."""
+        match = self.path_re.match(self.path)
+        if match is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        server = self.server
+        if match.group('index') is None:
+            body = server.specs[match.group('api')]
+        elif match.group('item'):
+            body = server.items[int(match.group('index')) % server.nb_definitions]
+        else:
+            body = server.arrays[int(match.group('index')) % server.nb_definitions]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Do not log the requests."""
+
+
+class StubServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP server of the synthetic apis."""
+
+    daemon_threads = True
+
+    def __init__(self, nb_apis, nb_paths, nb_definitions, nb_properties, array_size):
+        """Generate the specs and the docs, and bind to a free local port.
+
+        Args:
+            nb_apis: number of apis.
+            nb_paths: number of collection paths of each api.
+            nb_definitions: number of definitions of each api.
+            nb_properties: number of scalar properties of each definition.
+            array_size: number of items of the arrays.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.nb_definitions = nb_definitions
+        self.specs = {}
+        for index in range(nb_apis):
+            api = 'api{0}'.format(index)
+            self.specs[api] = json.dumps(make_spec(api, nb_paths, nb_definitions, nb_properties)).encode('utf-8')
+        docs = [make_doc(i, nb_definitions, nb_properties) for i in range(nb_definitions)]
+        self.items = [json.dumps(doc).encode('utf-8') for doc in docs]
+        self.arrays = [json.dumps([doc] * array_size).encode('utf-8') for doc in docs]
+        self.thread = None
+
+    @property
+    def url(self):
+        """Base url of the server."""
+        return 'http://{0}:{1}'.format(*self.server_address)
+
+    def start(self):
+        """Serve in a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop serving."""
+        self.shutdown()
+        self.server_close()
@@ -33,6 +33,10 @@ setup(
     include_package_data=True,
     setup_requires=['pytest-runner'],
     install_requires=requirements,
+    extras_require={
+        'aio': ['aiohttp>=3.3'],
+        'brotli': ['brotli'],
+    },
     license="MIT",
     zip_safe=False,
     keywords='swagger, aggregator, API, REST, swagger-aggregator',
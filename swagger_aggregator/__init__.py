@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from .swagger_aggregator import SwaggerAggregator
+from .swagger_aggregator import operations
 
 __author__ = 'Cyprien Guillemot'
 __email__ = 'cyprien.guillemot@gmail.com'
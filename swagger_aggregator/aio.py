@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import logging
+import time
+
+try:
+    import aiohttp
+    from aiohttp import web
+    from yarl import URL
+except ImportError:  # aiohttp is an optional dependency
+    aiohttp = None
+from requests.exceptions import Timeout
+
+from .swagger_aggregator import AUTH_SCOPE_HEADERS
+from .swagger_aggregator import HOP_BY_HOP_HEADERS
+from .swagger_aggregator import RETRY_ALL_POLICY
+from .swagger_aggregator import STREAM_CHUNK_SIZE
+from .swagger_aggregator import SwaggerAggregator
+from .swagger_aggregator import get_call_timeout
+from .swagger_aggregator import get_request_deadline
+from .swagger_aggregator import get_response_ttl
+from .swagger_aggregator import is_deadline_timeout
+from .swagger_aggregator import monotonic
+from .swagger_aggregator import timer
+
+logger = logging.getLogger(__name__)
+
+
+async def async_call_with_retry(call, action='get', policy=RETRY_ALL_POLICY, budget=None, deadline=None,
+                                on_retry=None):
+    """Await a coroutine function, retrying it with an exponential backoff on HTTP connection errors.
+
+    The backoff does not block the event loop.
+
+    Args:
+        call: coroutine function called without arguments.
+        action: http action of the call.
+        policy: RetryPolicy of the call.
+        budget: TokenBucket shared by the retries of all the calls.
+        deadline: time.time() after which the call must not be retried.
+        on_retry: function called before each retry with the number of the retry,
+                  the time slept before it and the exception.
+
+    Returns:
+        The result of the call.
+    """
+    total_sleep_time = 0
+    request_nb = 0
+    while True:
+        try:
+            return await call()
+        except aiohttp.ClientConnectionError as exc:
+            next_retry_sleep = policy.get_sleep(action, request_nb, total_sleep_time, deadline, budget)
+            if next_retry_sleep is None:
+                logger.error('Can not retry {action} call anymore, raising exception.'.format(action=action))
+                raise
+
+            total_sleep_time += next_retry_sleep
+            request_nb += 1
+
+            logger.warning('Got an exception: {exc}. Slept ({retry} seconds / {total} seconds)'
+                           .format(exc=exc,
+                                   retry=total_sleep_time,
+                                   total=policy.max_sleep_time))
+            if on_retry is not None:
+                on_retry(request_nb, next_retry_sleep, exc)
+            await asyncio.sleep(next_retry_sleep)
+
+
+def async_retry_http(call, on_retry=None):
+    """Wrapper used to retry HTTP Errors of a coroutine function with an exponential backoff
+
+    The backoff does not block the event loop.
+
+    Args:
+        call: coroutine function being wrapped
+        on_retry: function called before each retry, see async_call_with_retry
+
+    Returns:
+        the wrapped coroutine function
+    """
+
+    async def _retry_http(*args, **kwargs):
+        """Retry a coroutine call when catching aiohttp.ClientConnectionError"""
+        return await async_call_with_retry(lambda: call(*args, **kwargs), on_retry=on_retry)
+
+    # Keep the doc
+    _retry_http.__doc__ += call.__doc__ or ''
+
+    return _retry_http
+
+
+class AsyncSingleFlight(object):
+    """Share the result of a coroutine call between the identical calls made while it is in flight.
+
+    The call runs in its own task, so that cancelling one of the callers, e.g. when its client
+    disconnects, does not cancel it for the others. Must be used from a single event loop.
+    """
+
+    def __init__(self):
+        """Init without call in flight."""
+        self.flights = {}
+
+    async def do(self, key, call, deadline=None, share=None):
+        """Await a coroutine function, or the result of the identical call in flight.
+
+        Args:
+            key: key identifying identical calls.
+            call: coroutine function called without arguments.
+            deadline: time.time() after which the result of the call in flight is not waited for.
+            share: function applied to the result of the call in flight before returning it.
+
+        Returns:
+            The result of the call.
+        """
+        task = self.flights.get(key)
+        if task is not None:
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            result = await asyncio.wait_for(asyncio.shield(task), timeout)
+            return share(result) if share is not None else result
+
+        task = self.flights[key] = asyncio.ensure_future(call())
+
+        def done(task):
+            if self.flights.get(key) is task:
+                del self.flights[key]
+            if not task.cancelled():
+                task.exception()  # Do not log it when no caller waits for it anymore
+
+        task.add_done_callback(done)
+        return await asyncio.shield(task)
+
+
+def copy_response(response):
+    """Copy a buffered aiohttp response, so that it can be sent to another client.
+
+    Args:
+        response: aiohttp.web.Response with a body.
+
+    Returns:
+        A new aiohttp.web.Response.
+    """
+    return web.Response(body=response.body, status=response.status, headers=response.headers)
+
+
+class AsyncSwaggerAggregator(SwaggerAggregator):
+    """Create an asyncio API from an aggregation of API.
+
+    The generated operation functions are coroutines handling aiohttp requests.
+    They take the aiohttp request as `request` argument, e.g. when served by connexion's
+    AioHttpApp with pass_context_arg_name='request'.
+    """
+
+    def __init__(self, config_file, *args, **kwargs):
+        """Init the aggregation.
+
+        Args:
+            config_file: aggregation config.
+            *args: Arguments indicated at the top of the yaml config file.
+            **kwargs: Same keywords as SwaggerAggregator.
+        """
+        if aiohttp is None:
+            raise ImportError('aiohttp is required to use AsyncSwaggerAggregator')
+        super(AsyncSwaggerAggregator, self).__init__(config_file, *args, **kwargs)
+        self.async_sessions = {}
+        self.async_single_flight = AsyncSingleFlight()
+
+    def get_async_session(self, api_url):
+        """Get the keep-alive aiohttp session used to call the microservice at the given url.
+
+        Sessions are shared by all the operations targeting the same url.
+        They must be created and used in the same event loop.
+
+        Args:
+            api_url: url of the microservice.
+
+        Returns:
+            An aiohttp.ClientSession.
+        """
+        session = self.async_sessions.get(api_url)
+        if session is None or session.closed:
+            pool_config = self.get_pool_config(api_url)
+            connector = aiohttp.TCPConnector(limit=0,
+                                             limit_per_host=pool_config['pool_maxsize'] if pool_config['pool_block'] else 0,
+                                             force_close=not pool_config['keep_alive'])
+            session = aiohttp.ClientSession(connector=connector)
+            self.async_sessions[api_url] = session
+        return session
+
+    async def swagger_json_handler(self, request):
+        """aiohttp handler serving the aggregated swagger in JSON.
+
+        Args:
+            request: aiohttp request of the client.
+
+        Returns:
+            An aiohttp.web.Response, 304 if the client already has the swagger.
+        """
+        body, status, headers = self.get_serialized_swagger().get_response(request.headers)
+        return web.Response(body=body, status=status, headers=headers)
+
+    def register_swagger_json(self, app, rule='/swagger.json'):
+        """Serve the aggregated swagger in JSON from an aiohttp app.
+
+        Args:
+            app: aiohttp.web.Application.
+            rule: path of the swagger.
+        """
+        app.router.add_get(rule, self.swagger_json_handler)
+
+    @staticmethod
+    def get_client_timeout(timeouts, deadline=None):
+        """Get the aiohttp timeout of a call to a microservice, bounded by a deadline.
+
+        Args:
+            timeouts: dict of timeout settings, with connect and read keys.
+            deadline: time.time() after which the call must not be waited for.
+
+        Returns:
+            An aiohttp.ClientTimeout.
+        """
+        connect, read = get_call_timeout(timeouts, deadline)
+        return aiohttp.ClientTimeout(total=None if deadline is None else deadline - time.time(),
+                                     sock_connect=connect, sock_read=read)
+
+    async def close(self):
+        """Close the aiohttp sessions."""
+        for session in self.async_sessions.values():
+            await session.close()
+        self.async_sessions = {}
+
+    @staticmethod
+    async def stream_response_async(request, resp, deadline=None):
+        """Stream the response of a microservice to the client.
+
+        Args:
+            request: aiohttp request of the client.
+            resp: aiohttp.ClientResponse of the microservice.
+            deadline: time.time() after which the streaming is aborted.
+
+        Returns:
+            A prepared aiohttp.web.StreamResponse.
+        """
+        response = web.StreamResponse(status=resp.status)
+        for k, v in resp.headers.items():
+            if k.lower() not in HOP_BY_HOP_HEADERS + ('content-length', 'content-encoding'):
+                response.headers.add(k, v)
+        await response.prepare(request)
+        async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+            if deadline is not None and time.time() > deadline:
+                raise asyncio.TimeoutError('Deadline exceeded while streaming the response')
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+    def generate_operation_id_function(self, operation):
+        """Generate a coroutine function to handle an operation.
+
+        Args:
+            operation: Operation the generated function should handle.
+
+        Returns:
+            A coroutine function with the operation name as name.
+        """
+        metrics = self.metrics
+
+        async def func(request, **kwargs):
+            """Handle an aiohttp request for the current action.
+
+            """
+            # Get url from spec and aiohttp query
+            if metrics is not None:
+                start = timer()
+            url = operation.url_template.expand(kwargs, request.query_string)
+            if metrics is not None:
+                metrics.observe_phase(operation.name, 'url', timer() - start)
+
+            session = self.get_async_session(operation.api_url)
+
+            headers = self.get_forward_headers(request.headers)
+            deadline = get_request_deadline(request.headers, operation.timeouts['deadline'])
+
+            if not request.headers.get('Content-Type', '').startswith('multipart/form-data'):
+                data = await request.read()
+            else:
+                data = request.content
+
+            # Responses are cached and coalesced by operation, url and auth scope
+            request_key = cache_key = entry = None
+            if operation.cache_ttl is not None or operation.coalesce:
+                request_key = (operation, url) + tuple(request.headers.get(h) for h in AUTH_SCOPE_HEADERS)
+            if operation.cache_ttl is not None:
+                cache_key = request_key
+                entry = self.response_cache.get(cache_key)
+                if entry is not None:
+                    if entry[2] > monotonic():
+                        return web.json_response(entry[0][0], status=entry[0][1])
+                    if 'If-None-Match' in headers:  # The client revalidates its own version
+                        entry = None
+                    else:
+                        headers['If-None-Match'] = entry[1]
+
+            async def fetch():
+                """Call the microservice and get the filtered response."""
+                return await self.fetch_operation_async(request, operation, session, url, data, headers, deadline,
+                                                        request_key is not None, cache_key, entry)
+
+            try:
+                if operation.coalesce:
+                    return await self.async_single_flight.do(request_key, fetch, deadline, copy_response)
+                return await fetch()
+            except (asyncio.TimeoutError, Timeout) as exc:
+                logger.warning(u'{0} {1} timed out: {2!r}'.format(operation.action.upper(), url, exc))
+                return web.json_response({'message': 'Service {0} timed out'.format(operation.api)}, status=504)
+
+        if metrics is not None:
+            handle = func
+
+            async def func(request, **kwargs):
+                """Handle an aiohttp request for the current action, and observe its total duration.
+
+                """
+                start = timer()
+                try:
+                    return await handle(request, **kwargs)
+                finally:
+                    metrics.observe_phase(operation.name, 'total', timer() - start)
+        func.__name__ = operation.name
+        return func
+
+    async def fetch_operation_async(self, request, operation, session, url, data, headers, deadline, buffered=False,
+                                    cache_key=None, entry=None):
+        """Call the microservice of an operation and get its filtered response.
+
+        Args:
+            request: aiohttp request of the client.
+            operation: Operation being called.
+            session: aiohttp.ClientSession doing the call.
+            url: url of the call.
+            data: body of the call.
+            headers: headers of the call.
+            deadline: time.time() after which the call is aborted.
+            buffered: True if the response must not be streamed.
+            cache_key: key of the result in the response cache, None if it is not cached.
+            entry: expired entry of the response cache being revalidated.
+
+        Returns:
+            An aiohttp response.
+        """
+        metrics = self.metrics
+        breaker = self.get_circuit_breaker(operation.api)
+        if not breaker.allow_request():
+            if metrics is not None:
+                metrics.count_error(operation.name, 'circuit_open')
+            error, status, error_headers = self.get_circuit_open_error(operation.api, breaker)
+            return web.json_response(error, status=status, headers=error_headers)
+        record = breaker.release  # Cancelled calls and the ones due to fail at the client deadline
+        try:
+            if metrics is not None:
+                start = timer()
+            # The url is already encoded
+            resp = await async_call_with_retry(
+                lambda: session.request(operation.action, URL(url, encoded=True), data=data, headers=headers,
+                                        timeout=self.get_client_timeout(operation.timeouts, deadline)),
+                operation.action, operation.retry_policy, self.retry_budget, deadline,
+                None if metrics is None else lambda *_: metrics.count_retry(operation.name))
+            record = breaker.record_failure if resp.status >= 500 else breaker.record_success
+        except Exception as exc:
+            if not is_deadline_timeout(exc, deadline, (asyncio.TimeoutError, Timeout)):
+                record = breaker.record_failure
+            if metrics is not None:
+                metrics.count_error(operation.name,
+                                    'timeout' if isinstance(exc, (asyncio.TimeoutError, Timeout)) else 'connection')
+            raise
+        finally:
+            record()
+        if metrics is not None:
+            metrics.observe_phase(operation.name, 'upstream', timer() - start)
+            metrics.count_status(operation.name, resp.status)
+        try:
+            if entry is not None and resp.status == 304:  # Cached response still valid
+                self.response_cache.set(cache_key, entry[0], get_response_ttl(resp.headers, operation.cache_ttl),
+                                        entry[1])
+                return web.json_response(entry[0][0], status=entry[0][1])
+
+            # Pass the response through when there is nothing to filter in it
+            plan = self.get_filter_plan(operation.name, resp.status)
+            is_json = 'json' in resp.headers.get('Content-Type', '').lower()
+            if self.yaml_file.get('stream_responses', True) and not buffered and (plan is None or not is_json):
+                return await self.stream_response_async(request, resp, deadline)
+
+            if metrics is not None:
+                start = timer()
+            body = await resp.read()
+            try:
+                doc = json.loads(body.decode(resp.charset or 'utf-8'))
+            except ValueError:
+                return web.Response(body=body, status=resp.status, content_type=resp.content_type)
+            if metrics is not None:
+                metrics.observe_phase(operation.name, 'parse', timer() - start)
+
+            if plan is not None:
+                if metrics is not None:
+                    start = timer()
+                doc = self.filter_definition(doc, plan)
+                if metrics is not None:
+                    metrics.observe_phase(operation.name, 'filter', timer() - start)
+            if cache_key is not None and resp.status == 200:
+                self.response_cache.set(cache_key, (doc, resp.status),
+                                        get_response_ttl(resp.headers, operation.cache_ttl),
+                                        resp.headers.get('ETag'))
+            if metrics is None:
+                return web.json_response(doc, status=resp.status)
+            start = timer()
+            response = web.json_response(doc, status=resp.status)
+            metrics.observe_phase(operation.name, 'serialize', timer() - start)
+            return response
+        finally:
+            resp.release()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import collections
+import threading
+
+# Default upper bounds of the buckets of the phase duration histograms, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class MetricsSink(object):
+    """Receive the metrics of the operation functions.
+
+    Give a sink to SwaggerAggregator with its metrics keyword. Every method does nothing
+    by default, subclasses override the ones they need. Methods are called from the
+    threads handling the requests, they must be thread safe and fast.
+    """
+
+    def observe_phase(self, operation, phase, duration):
+        """Observe the duration of a phase of an operation call.
+
+        Phases are url, upstream (until the response headers, retries included),
+        parse, filter, serialize and total.
+
+        Args:
+            operation: name of the operation.
+            phase: name of the phase.
+            duration: duration in seconds.
+        """
+
+    def count_retry(self, operation):
+        """Count a retry of the upstream call of an operation.
+
+        Args:
+            operation: name of the operation.
+        """
+
+    def count_status(self, operation, status_code):
+        """Count an upstream response of an operation.
+
+        Args:
+            operation: name of the operation.
+            status_code: status code of the response.
+        """
+
+    def count_error(self, operation, kind):
+        """Count an upstream call of an operation without response.
+
+        Args:
+            operation: name of the operation.
+            kind: timeout, circuit_open or connection.
+        """
+
+
+class CallbackSink(MetricsSink):
+    """Forward the metrics to a callback.
+
+    The callback is called with the event name (phase, retry, status or error),
+    the operation name, and the other arguments of the event as keywords.
+    """
+
+    def __init__(self, callback):
+        """Init the sink.
+
+        Args:
+            callback: function called for each event.
+        """
+        self.callback = callback
+
+    def observe_phase(self, operation, phase, duration):
+        """Forward a phase duration."""
+        self.callback('phase', operation, phase=phase, duration=duration)
+
+    def count_retry(self, operation):
+        """Forward a retry."""
+        self.callback('retry', operation)
+
+    def count_status(self, operation, status_code):
+        """Forward an upstream response."""
+        self.callback('status', operation, status_code=status_code)
+
+    def count_error(self, operation, kind):
+        """Forward an upstream error."""
+        self.callback('error', operation, kind=kind)
+
+
+class Histogram(object):
+    """Histogram of observed values."""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        """Init an empty histogram.
+
+        Args:
+            buckets: sorted upper bounds of the buckets, an infinite bucket is added.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        """Add a value to the histogram."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class InMemoryMetrics(MetricsSink):
+    """Keep the metrics in process, as Prometheus-style counters and histograms."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """Init empty metrics.
+
+        Args:
+            buckets: upper bounds of the buckets of the phase duration histograms, in seconds.
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.phases = {}
+        self.retries = collections.Counter()
+        self.statuses = collections.Counter()
+        self.errors = collections.Counter()
+        self._lock = threading.Lock()
+
+    def observe_phase(self, operation, phase, duration):
+        """Add a phase duration to its histogram."""
+        with self._lock:
+            histogram = self.phases.get((operation, phase))
+            if histogram is None:
+                histogram = self.phases[(operation, phase)] = Histogram(self.buckets)
+            histogram.observe(duration)
+
+    def count_retry(self, operation):
+        """Count a retry."""
+        with self._lock:
+            self.retries[operation] += 1
+
+    def count_status(self, operation, status_code):
+        """Count an upstream response."""
+        with self._lock:
+            self.statuses[(operation, status_code)] += 1
+
+    def count_error(self, operation, kind):
+        """Count an upstream error."""
+        with self._lock:
+            self.errors[(operation, kind)] += 1
+
+    def render(self):
+        """Render the metrics in the Prometheus text format.
+
+        Returns:
+            The metrics as text.
+        """
+        lines = []
+        with self._lock:
+            lines.append('# TYPE swagger_aggregator_phase_seconds histogram')
+            for (operation, phase), histogram in sorted(self.phases.items()):
+                labels = 'operation="{0}",phase="{1}"'.format(operation, phase)
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('swagger_aggregator_phase_seconds_bucket{{{0},le="{1}"}} {2}'.format(
+                        labels, bound, cumulative))
+                lines.append('swagger_aggregator_phase_seconds_sum{{{0}}} {1}'.format(labels, histogram.sum))
+                lines.append('swagger_aggregator_phase_seconds_count{{{0}}} {1}'.format(labels, histogram.count))
+
+            lines.append('# TYPE swagger_aggregator_retries_total counter')
+            for operation, count in sorted(self.retries.items()):
+                lines.append('swagger_aggregator_retries_total{{operation="{0}"}} {1}'.format(operation, count))
+
+            lines.append('# TYPE swagger_aggregator_upstream_responses_total counter')
+            for (operation, status_code), count in sorted(self.statuses.items()):
+                lines.append('swagger_aggregator_upstream_responses_total{{operation="{0}",status="{1}"}} {2}'.format(
+                    operation, status_code, count))
+
+            lines.append('# TYPE swagger_aggregator_upstream_errors_total counter')
+            for (operation, kind), count in sorted(self.errors.items()):
+                lines.append('swagger_aggregator_upstream_errors_total{{operation="{0}",kind="{1}"}} {2}'.format(
+                    operation, kind, count))
+        return '\n'.join(lines) + '\n'
@@ -1,173 +1,1798 @@
 # -*- coding: utf-8 -*-
 
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+import codecs
+import collections
+import copy
+import fnmatch
+import gzip
+import hashlib
+import io
+import itertools
 import json
 import logging
+import math
 import os
 import random
 import re
 import six
-import sys
+import tempfile
+import threading
 import time
 import yaml
 
 import flask
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError
 from requests.exceptions import RequestException
-from shortuuid import uuid
+from requests.exceptions import Timeout
+from six.moves.urllib.parse import quote
 from simplejson.scanner import JSONDecodeError
 
 from swagger_parser import SwaggerParser
 
+try:
+    import brotli
+except ImportError:  # brotli is an optional dependency
+    brotli = None
+
 logger = logging.getLogger(__name__)
 
+# Use libyaml when it is available
+try:
+    YamlLoader = yaml.CSafeLoader
+    YamlDumper = yaml.CSafeDumper
+except AttributeError:
+    YamlLoader = yaml.SafeLoader
+    YamlDumper = yaml.SafeDumper
+
+# Default connection pool settings of the upstream sessions.
+DEFAULT_POOL_CONFIG = {
+    'pool_connections': 10,
+    'pool_maxsize': 10,
+    'pool_block': False,
+    'keep_alive': True
+}
+
+# Size of the chunks read from the microservice when streaming a response.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Characters kept as is when encoding a query string.
+QUERY_STRING_SAFE_CHARS = "=&;%+/?:@!$'()*,~"
+
+# Schema keywords for which the definition of a doc can not be known from the schema only.
+AMBIGUOUS_SCHEMA_KEYS = ('allOf', 'anyOf', 'oneOf', 'discriminator')
+
+# Keys of a swagger path item that are operations.
+HTTP_METHODS = ('get', 'put', 'post', 'delete', 'options', 'head', 'patch')
+
+# Hop-by-hop headers must not be forwarded between the client and the microservice.
+HOP_BY_HOP_HEADERS = ('connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                      'te', 'trailers', 'transfer-encoding', 'upgrade')
+
+
+# Exponential backoff settings of the retries.
+# Inspired from https://developers.google.com/api-client-library/java/google-http-java-client/reference/
+# 1.20.0/com/google/api/client/util/ExponentialBackOff
+RETRY_MULTIPLIER = 1.5
+RETRY_INTERVAL = 0.5
+RETRY_RANDOMIZATION_FACTOR = 0.5
+# Capped to 10 seconds
+RETRY_MAX_SLEEP_TIME = 10
+
+# Only the calls with these actions are retried by default, retrying others could duplicate their effect.
+IDEMPOTENT_METHODS = ('get', 'head', 'options', 'put', 'delete')
+
+# Default retry settings, overridden by the retry section of the config file and of each api.
+DEFAULT_RETRY_CONFIG = {
+    'methods': IDEMPOTENT_METHODS,
+    'max_retries': None,
+    'max_sleep_time': RETRY_MAX_SLEEP_TIME
+}
+
+# Default retry budget shared by all the apis: tokens earned per second and max tokens.
+DEFAULT_RETRY_BUDGET = {
+    'rate': 10,
+    'capacity': 100
+}
+
+# Default circuit breaker settings, overridden by the circuit_breaker section of the config file and of each api.
+DEFAULT_CIRCUIT_BREAKER_CONFIG = {
+    'failure_threshold': 5,
+    'recovery_timeout': 30,
+    'half_open_max_calls': 1
+}
+
+# Default timeouts of the calls to the microservices, in seconds, overridden by the timeouts section
+# of the config file, of each api and of each operation. The deadline bounds the whole call, retries included.
+DEFAULT_TIMEOUT_CONFIG = {
+    'connect': 5,
+    'read': 30,
+    'deadline': None
+}
+
+# Default time to live of the cached responses, in seconds, and max number of cached responses.
+DEFAULT_CACHE_TTL = 60
+DEFAULT_RESPONSE_CACHE_CONFIG = {
+    'max_entries': 1024
+}
+
+# Headers of the client requests scoping the responses a client can get.
+AUTH_SCOPE_HEADERS = ('Authorization', 'Cookie')
+
+# Default settings of the file the aggregated swagger is written to.
+DEFAULT_OUTPUT_CONFIG = {
+    'format': 'yaml',
+    'minify': False,
+    'gzip': False,
+    'path': None
+}
+
+# Header of the client requests giving the time the client waits for the response, in seconds.
+REQUEST_TIMEOUT_HEADER = 'X-Request-Timeout'
+
+monotonic = getattr(time, 'monotonic', time.time)
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def get_retry_sleep(request_nb):
+    """Get the time to sleep before a retry.
+
+    Args:
+        request_nb: number of failed requests before this retry, minus one.
+
+    Returns:
+        Time to sleep in seconds.
+    """
+    return (RETRY_MULTIPLIER ** request_nb *
+            (RETRY_INTERVAL * (random.randint(0, int(2 * RETRY_RANDOMIZATION_FACTOR * 1000)) / 1000. +
+                               1 - RETRY_RANDOMIZATION_FACTOR)))
+
+
+class RetryPolicy(object):
+    """Retry settings of the calls to a microservice."""
+
+    __slots__ = ('methods', 'max_retries', 'max_sleep_time')
+
+    def __init__(self, methods=IDEMPOTENT_METHODS, max_retries=None, max_sleep_time=RETRY_MAX_SLEEP_TIME):
+        """Init the policy.
+
+        Args:
+            methods: http actions whose calls are retried.
+            max_retries: max number of retries of a call, None for no limit.
+            max_sleep_time: max total time slept between the retries of a call, in seconds.
+        """
+        self.methods = frozenset(method.lower() for method in methods)
+        self.max_retries = max_retries
+        self.max_sleep_time = max_sleep_time
+
+    def get_sleep(self, action, request_nb, total_sleep_time, deadline=None, budget=None):
+        """Get the time to sleep before retrying a failed call.
+
+        Args:
+            action: http action of the call.
+            request_nb: number of retries already done.
+            total_sleep_time: time already slept between the retries.
+            deadline: time.time() after which the call must not be retried.
+            budget: TokenBucket a retry is taken from.
+
+        Returns:
+            Time to sleep in seconds, None if the call must not be retried.
+        """
+        if action.lower() not in self.methods:
+            return None
+        if self.max_retries is not None and request_nb >= self.max_retries:
+            return None
+        next_retry_sleep = get_retry_sleep(request_nb)
+        if total_sleep_time + next_retry_sleep > self.max_sleep_time:
+            return None
+        if deadline is not None and time.time() + next_retry_sleep >= deadline:
+            return None
+        if budget is not None and not budget.consume():
+            return None
+        return next_retry_sleep
+
+
+class TokenBucket(object):
+    """Thread safe token bucket, refilled continuously."""
+
+    def __init__(self, rate, capacity):
+        """Init a full bucket.
+
+        Args:
+            rate: tokens added per second.
+            capacity: max number of tokens in the bucket.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, tokens=1):
+        """Take tokens from the bucket.
+
+        Args:
+            tokens: number of tokens to take.
+
+        Returns:
+            True if the tokens were taken, False if the bucket does not contain enough tokens.
+        """
+        with self._lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+
+# Retry the idempotent calls during RETRY_MAX_SLEEP_TIME seconds.
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+# Retry every call during RETRY_MAX_SLEEP_TIME seconds, as retry_http always did.
+RETRY_ALL_POLICY = RetryPolicy(methods=HTTP_METHODS)
+
+
+class CircuitBreaker(object):
+    """Circuit breaker of the calls to a microservice.
+
+    While closed, calls go through. After failure_threshold consecutive failures it opens,
+    and calls fail fast. After recovery_timeout seconds it is half open: up to
+    half_open_max_calls probe calls go through, a success closes it, a failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30, half_open_max_calls=1):
+        """Init a closed circuit breaker.
+
+        Args:
+            failure_threshold: number of consecutive failures opening the circuit.
+            recovery_timeout: time the circuit stays open before letting probe calls through, in seconds.
+            half_open_max_calls: max number of concurrent probe calls while half open.
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.failures = 0
+        self.probes = 0
+        self.opened_at = None
+        self._state = self.CLOSED
+        self._lock = threading.Lock()
+
+    def _get_state(self):
+        """Get the state, switching from open to half open after the recovery timeout."""
+        if self._state == self.OPEN and monotonic() - self.opened_at >= self.recovery_timeout:
+            self._state = self.HALF_OPEN
+            self.probes = 0
+        return self._state
+
+    @property
+    def state(self):
+        """State of the circuit: CLOSED, OPEN or HALF_OPEN."""
+        with self._lock:
+            return self._get_state()
+
+    def allow_request(self):
+        """Check if a call can go through, and count it as a probe when half open.
+
+        Returns:
+            True if the call can be done, False if it must fail fast.
+        """
+        with self._lock:
+            state = self._get_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and self.probes < self.half_open_max_calls:
+                self.probes += 1
+                return True
+            return False
+
+    def record_success(self):
+        """Record a successful call, closing the circuit."""
+        with self._lock:
+            if self._get_state() == self.OPEN:  # Call started before the circuit opened
+                return
+            if self._state == self.HALF_OPEN:
+                logger.info('Circuit closed after a successful probe.')
+            self._state = self.CLOSED
+            self.failures = 0
+            self.probes = 0
+
+    def release(self):
+        """Record a call that neither succeeded nor failed, giving its probe slot back when half open."""
+        with self._lock:
+            if self._get_state() == self.HALF_OPEN and self.probes > 0:
+                self.probes -= 1
+
+    def record_failure(self):
+        """Record a failed call, opening the circuit after too many of them."""
+        with self._lock:
+            self.failures += 1
+            state = self._get_state()
+            if state == self.HALF_OPEN or (state == self.CLOSED and self.failures >= self.failure_threshold):
+                logger.warning('Circuit opened after {0} consecutive failures.'.format(self.failures))
+                self._state = self.OPEN
+                self.opened_at = monotonic()
+                self.probes = 0
+
+    def get_retry_after(self):
+        """Get the time before probe calls are let through.
+
+        Returns:
+            Time in seconds, 0 if the circuit is not open.
+        """
+        with self._lock:
+            if self._get_state() != self.OPEN:
+                return 0
+            return max(0, self.recovery_timeout - (monotonic() - self.opened_at))
+
+    def get_status(self):
+        """Get the status of the circuit, for monitoring.
+
+        Returns:
+            Dict with the state, the number of consecutive failures and the retry after time.
+        """
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'retry_after': self.get_retry_after()
+        }
+
+
+def call_with_retry(call, action='get', policy=RETRY_ALL_POLICY, budget=None, deadline=None, on_retry=None):
+    """Call a function, retrying it with an exponential backoff on HTTP connection errors.
+
+    Args:
+        call: function called without arguments.
+        action: http action of the call.
+        policy: RetryPolicy of the call.
+        budget: TokenBucket shared by the retries of all the calls.
+        deadline: time.time() after which the call must not be retried.
+        on_retry: function called before each retry with the number of the retry,
+                  the time slept before it and the exception.
+
+    Returns:
+        The result of the call.
+    """
+    total_sleep_time = 0
+    request_nb = 0
+    while True:
+        try:
+            return call()
+        except ConnectionError as exc:
+            next_retry_sleep = policy.get_sleep(action, request_nb, total_sleep_time, deadline, budget)
+            if next_retry_sleep is None:
+                logger.error('Can not retry {action} call anymore, raising exception.'.format(action=action))
+                raise
+
+            total_sleep_time += next_retry_sleep
+            request_nb += 1
+
+            logger.warning('Got an exception: {exc}. Slept ({retry} seconds / {total} seconds)'
+                           .format(exc=exc,
+                                   retry=total_sleep_time,
+                                   total=policy.max_sleep_time))
+            if on_retry is not None:
+                on_retry(request_nb, next_retry_sleep, exc)
+            time.sleep(next_retry_sleep)
+
+
+def retry_http(call, on_retry=None):
+    """Wrapper used to retry HTTP Errors with an exponential backoff
+
+    Args:
+        call: function being wrapped
+        on_retry: function called before each retry, see call_with_retry
+
+    Returns:
+        the wrapped function
+    """
+
+    def _retry_http(*args, **kwargs):
+        """Retry a function call when catching requests.exceptions.ConnectionError"""
+        return call_with_retry(lambda: call(*args, **kwargs), on_retry=on_retry)
+
+    # Keep the doc
+    _retry_http.__doc__ += call.__doc__ or ''
+
+    return _retry_http
+
+
+def get_request_deadline(headers, timeout=None):
+    """Get the deadline of a client request.
+
+    It is the earliest of the deadline given by the client in its REQUEST_TIMEOUT_HEADER header,
+    and of the given timeout.
+
+    Args:
+        headers: headers of the client request.
+        timeout: max duration of the request in seconds, None for no limit.
+
+    Returns:
+        time.time() after which the client does not get a response anymore, None if unknown.
+    """
+    now = time.time()
+    deadline = now + timeout if timeout is not None else None
+    try:
+        client_deadline = now + float(headers[REQUEST_TIMEOUT_HEADER])
+    except (KeyError, ValueError):
+        return deadline
+    return client_deadline if deadline is None else min(deadline, client_deadline)
+
+
+class DeadlineExceeded(Timeout):
+    """The deadline of a client request expired before a call to a microservice."""
+
+
+def is_deadline_timeout(exc, deadline, timeout_types=(Timeout,)):
+    """Check if a timeout of a call to a microservice is due to the deadline of the client request.
+
+    Such timeouts are not failures of the microservice: either the deadline expired before the call,
+    or it was shorter than the connect and read timeouts of the call and the call timed out at the deadline.
+
+    Args:
+        exc: exception raised by the call.
+        deadline: time.time() after which the call must not be waited for.
+        timeout_types: types of the timeout exceptions of the http client.
+
+    Returns:
+        True if the timeout is due to the deadline.
+    """
+    if isinstance(exc, DeadlineExceeded):
+        return True
+    return isinstance(exc, timeout_types) and deadline is not None and time.time() >= deadline
+
+
+def get_call_timeout(timeouts, deadline=None):
+    """Get the connect and read timeouts of a call to a microservice, bounded by a deadline.
+
+    Args:
+        timeouts: dict of timeout settings, with connect and read keys.
+        deadline: time.time() after which the call must not be waited for.
+
+    Returns:
+        (connect timeout, read timeout) in seconds.
+
+    Raises:
+        DeadlineExceeded: if the deadline expired.
+    """
+    connect, read = timeouts['connect'], timeouts['read']
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded('Deadline exceeded')
+        connect = remaining if connect is None else min(connect, remaining)
+        read = remaining if read is None else min(read, remaining)
+    return connect, read
+
+
+def iter_until(chunks, deadline=None):
+    """Iterate over the chunks of a response until a deadline.
+
+    Args:
+        chunks: iterator of chunks.
+        deadline: time.time() after which the iteration is stopped.
+
+    Yields:
+        The chunks received before the deadline.
+
+    Raises:
+        Timeout: if the deadline is exceeded.
+    """
+    for chunk in chunks:
+        if deadline is not None and time.time() > deadline:
+            raise DeadlineExceeded('Deadline exceeded while streaming the response')
+        yield chunk
+
+
+def get_response_ttl(headers, ttl):
+    """Get the time a response of a microservice can be cached, according to its Cache-Control header.
+
+    Args:
+        headers: headers of the response.
+        ttl: time to live of the operation's responses, in seconds.
+
+    Returns:
+        Time to live in seconds, None if the response must not be cached.
+    """
+    directives = {}
+    for directive in headers.get('Cache-Control', '').lower().split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name] = value.strip('"')
+    if any(name in directives for name in ('no-store', 'no-cache', 'private')) or \
+            headers.get('Vary', '').strip() == '*':
+        return None
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                return min(ttl, int(directives[name]))
+            except ValueError:
+                return None
+    return ttl
+
+
+class ResponseCache(object):
+    """Thread safe LRU cache of the filtered responses of the operations.
+
+    Entries are (result, etag, expiration time) tuples. Expired entries
+    with an etag are kept, so that they can be revalidated.
+    """
+
+    def __init__(self, max_entries=1024):
+        """Init an empty cache.
+
+        Args:
+            max_entries: max number of cached responses.
+        """
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get a cached response.
+
+        Args:
+            key: key of the response.
+
+        Returns:
+            (result, etag, expiration time) tuple, None if the response is not cached.
+        """
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or (entry[1] is None and entry[2] <= monotonic()):
+                return None
+            self.entries[key] = entry  # Most recently used
+            return entry
+
+    def set(self, key, result, ttl, etag=None):
+        """Cache a response, evicting the least recently used ones if the cache is full.
+
+        Args:
+            key: key of the response.
+            result: filtered result of the operation.
+            ttl: time to live of the response in seconds, None to remove it from the cache.
+            etag: ETag of the response of the microservice.
+        """
+        with self._lock:
+            self.entries.pop(key, None)
+            if ttl is None or (ttl <= 0 and etag is None):
+                return
+            self.entries[key] = (result, etag, monotonic() + ttl)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all the cached responses."""
+        with self._lock:
+            self.entries.clear()
+
+
+class RouteIndex(object):
+    """Index of operation rules, such as the ones of the exclude_paths section.
+
+    Rules are written like 'GET /pets/{petId}'. The method is either a comma separated
+    list of methods, or * for all of them. The path is either exact, a prefix when it ends
+    with its only *, e.g. '/admin/*', or a glob pattern using *, ? and [].
+    """
+
+    def __init__(self, rules=()):
+        """Compile the rules.
+
+        Args:
+            rules: list of rules.
+        """
+        self.exact = {}
+        self.prefixes = []
+        self.patterns = []
+        self._path_methods = {}
+        for rule in rules:
+            self.add(rule)
+
+    def add(self, rule):
+        """Add a rule to the index.
+
+        Args:
+            rule: rule like 'GET /pets/{petId}'.
+        """
+        method, _, path = rule.strip().partition(' ')
+        path = path.strip()
+        if not path:
+            raise ValueError(u'Invalid rule {0}, expected "METHOD /path"'.format(rule))
+        if method == '*':
+            methods = frozenset(HTTP_METHODS)
+        else:
+            methods = frozenset(m.strip().lower() for m in method.split(','))
+
+        if not any(c in path for c in '*?['):
+            self.exact[path] = self.exact.get(path, frozenset()) | methods
+        elif path.endswith('*') and not any(c in path[:-1] for c in '*?['):
+            self.prefixes.append((path[:-1], methods))
+        else:
+            self.patterns.append((re.compile(fnmatch.translate(path)), methods))
+        self._path_methods = {}
+
+    def get_methods(self, path):
+        """Get the methods of a path matched by the rules.
+
+        Args:
+            path: path of the operations.
+
+        Returns:
+            frozenset of lower case methods.
+        """
+        methods = self._path_methods.get(path)
+        if methods is None:
+            methods = self.exact.get(path, frozenset())
+            for prefix, prefix_methods in self.prefixes:
+                if path.startswith(prefix):
+                    methods = methods | prefix_methods
+            for pattern, pattern_methods in self.patterns:
+                if pattern.match(path):
+                    methods = methods | pattern_methods
+            self._path_methods[path] = methods
+        return methods
+
+    def match(self, path, action):
+        """Check if an operation is matched by the rules.
+
+        Args:
+            path: path of the operation.
+            action: http action of the operation.
+
+        Returns:
+            True if the operation is matched.
+        """
+        return action in self.get_methods(path)
+
+
+class SingleFlight(object):
+    """Share the result of a call between the identical calls made while it is in flight."""
+
+    class Flight(object):
+        """Call in flight."""
+
+        def __init__(self):
+            """Init a call without result."""
+            self.done = threading.Event()
+            self.result = None
+            self.exc = None
+
+    def __init__(self):
+        """Init without call in flight."""
+        self.flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, call, deadline=None):
+        """Call a function, or wait for the result of the identical call in flight.
+
+        Args:
+            key: key identifying identical calls.
+            call: function called without arguments.
+            deadline: time.time() after which the result of the call in flight is not waited for.
+
+        Returns:
+            The result of the call.
+
+        Raises:
+            Timeout: if the deadline is exceeded while waiting for the call in flight.
+        """
+        with self._lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = self.Flight()
+
+        if not leader:
+            if not flight.done.wait(None if deadline is None else max(0, deadline - time.time())):
+                raise DeadlineExceeded('Deadline exceeded while waiting for an identical call')
+            if flight.exc is not None:
+                raise flight.exc
+            return flight.result
+
+        try:
+            flight.result = call()
+            return flight.result
+        except Exception as exc:
+            flight.exc = exc
+            raise
+        finally:
+            with self._lock:
+                del self.flights[key]
+            flight.done.set()
+
+
+def dump_yaml(swagger, minify=False):
+    """Serialize a swagger spec in YAML.
+
+    Args:
+        swagger: swagger spec.
+        minify: True to use the flow style.
+
+    Returns:
+        UTF-8 encoded YAML.
+    """
+    return yaml.dump(swagger, Dumper=YamlDumper, default_flow_style=minify).encode('utf-8')
+
+
+def dump_json(swagger, minify=False):
+    """Serialize a swagger spec in JSON.
+
+    Args:
+        swagger: swagger spec.
+        minify: True to remove the whitespaces.
+
+    Returns:
+        UTF-8 encoded JSON.
+    """
+    if minify:
+        return json.dumps(swagger, separators=(',', ':')).encode('utf-8')
+    return json.dumps(swagger, indent=2, sort_keys=True).encode('utf-8')
+
+
+def gzip_bytes(data):
+    """Compress bytes with gzip, the same bytes always give the same result.
+
+    Args:
+        data: bytes to compress.
+
+    Returns:
+        Compressed bytes.
+    """
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def get_accepted_encodings(accept_encoding):
+    """Get the content codings accepted by a client.
+
+    Args:
+        accept_encoding: Accept-Encoding header of the client request.
+
+    Returns:
+        Set of lower case content codings, without the ones with a zero quality.
+    """
+    encodings = set()
+    for coding in accept_encoding.lower().split(','):
+        name, _, params = coding.partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if name.strip():
+            encodings.add(name.strip())
+    return encodings
+
+
+class SerializedSwagger(object):
+    """Aggregated swagger serialized in minified JSON, with its compressed variants and ETags."""
+
+    __slots__ = ('body', 'etag', 'variants')
+
+    def __init__(self, swagger):
+        """Serialize and compress the swagger.
+
+        Args:
+            swagger: aggregated swagger spec.
+        """
+        self.body = dump_json(swagger, minify=True)
+        digest = hashlib.sha1(self.body).hexdigest()
+        self.etag = '"{0}"'.format(digest)
+
+        # Content coding: (body, ETag), each variant has its own ETag
+        self.variants = {'gzip': (gzip_bytes(self.body), '"{0}-gzip"'.format(digest))}
+        if brotli is not None:
+            self.variants['br'] = (brotli.compress(self.body), '"{0}-br"'.format(digest))
+
+    def is_not_modified(self, if_none_match):
+        """Check if the client already has the swagger.
+
+        Args:
+            if_none_match: If-None-Match header of the client request.
+
+        Returns:
+            True if one of the ETags of the swagger matches.
+        """
+        if not if_none_match:
+            return False
+        etags = set(tag.strip().replace('W/', '', 1) for tag in if_none_match.split(','))
+        return '*' in etags or self.etag in etags or any(etag in etags for _, etag in self.variants.values())
+
+    def get_response(self, request_headers):
+        """Get the response to a client request of the swagger.
+
+        Args:
+            request_headers: headers of the client request.
+
+        Returns:
+            (body, status code, headers)
+        """
+        encodings = get_accepted_encodings(request_headers.get('Accept-Encoding', ''))
+        body, etag, headers = self.body, self.etag, {'Content-Type': 'application/json',
+                                                     'Vary': 'Accept-Encoding',
+                                                     'Cache-Control': 'no-cache'}
+        for encoding in ('br', 'gzip'):
+            if encoding in encodings and encoding in self.variants:
+                body, etag = self.variants[encoding]
+                headers['Content-Encoding'] = encoding
+                break
+        headers['ETag'] = etag
+
+        if self.is_not_modified(request_headers.get('If-None-Match')):
+            headers.pop('Content-Encoding', None)
+            return (b'', 304, headers)
+        return (body, 200, headers)
+
+
+# Serializers of the aggregated swagger, by output format: (file extension, function).
+SWAGGER_SERIALIZERS = {
+    'yaml': ('yaml', dump_yaml),
+    'json': ('json', dump_json)
+}
+
+
+def get_default_file_mode():
+    """Get the permissions of the files created with open, following the umask of the process.
+
+    Reading the umask changes it for a moment, so it must not be done while other threads create files.
+
+    Returns:
+        The file mode.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# Read once at import, before the threads writing files are started
+DEFAULT_FILE_MODE = get_default_file_mode()
+
+
+def write_file_atomic(path, data, mode=DEFAULT_FILE_MODE):
+    """Write a file atomically, readers see either the old file or the new one.
+
+    Args:
+        path: path of the file.
+        data: bytes to write.
+        mode: permissions of the file. Defaults to the ones of a file created with open.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, mode)
+        getattr(os, 'replace', os.rename)(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def namespace_refs(node, prefix):
+    """Prefix the name of the definitions referenced in the given node.
+
+    Unchanged subtrees are not copied, they are returned as is.
+
+    Args:
+        node: swagger spec, or part of it.
+        prefix: prefix to add to the definition names.
+
+    Returns:
+        The node with its references renamed.
+    """
+    if isinstance(node, dict):
+        renamed = None
+        for key, value in node.items():
+            if key == '$ref' and isinstance(value, six.string_types) and value.startswith('#/definitions/'):
+                new_value = u'#/definitions/{0}{1}'.format(prefix, value[len('#/definitions/'):])
+            else:
+                new_value = namespace_refs(value, prefix)
+            if new_value is not value:
+                if renamed is None:
+                    renamed = dict(node)
+                renamed[key] = new_value
+        return node if renamed is None else renamed
+    elif isinstance(node, list):
+        renamed = None
+        for index, value in enumerate(node):
+            new_value = namespace_refs(value, prefix)
+            if new_value is not value:
+                if renamed is None:
+                    renamed = list(node)
+                renamed[index] = new_value
+        return node if renamed is None else renamed
+    return node
+
+
+def iter_json_array(chunks, encoding='utf-8'):
+    """Incrementally decode the items of a JSON array.
+
+    Args:
+        chunks: iterable of bytes containing a JSON array.
+        encoding: encoding of the chunks.
+
+    Returns:
+        A generator of the decoded items.
+
+    Raises:
+        ValueError: the chunks do not contain a valid JSON array.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    chunks = iter(chunks)
+    buf = u''
+    pos = 0
+    eof = False
+    # Size the rest of the buffer must reach before decoding an incomplete item again.
+    # It doubles on each try to keep the decoding of big items linear.
+    min_size = 0
+    state = 'start'
+
+    while True:
+        while pos < len(buf) and buf[pos] in u' \t\n\r':
+            pos += 1
+
+        # Read the next chunk
+        if not eof and (pos >= len(buf) or len(buf) - pos < min_size):
+            buf = buf[pos:]
+            pos = 0
+            try:
+                buf += text_decoder.decode(next(chunks))
+            except StopIteration:
+                buf += text_decoder.decode(b'', final=True)
+                eof = True
+            continue
+        if pos >= len(buf):
+            raise ValueError('Unexpected end of JSON array')
+
+        char = buf[pos]
+        if state == 'start':
+            if char != u'[':
+                raise ValueError('Not a JSON array')
+            state = 'first'
+            pos += 1
+        elif char == u']' and state in ('first', 'next'):
+            return
+        elif char == u',' and state == 'next':
+            state = 'item'
+            pos += 1
+        elif state in ('first', 'item'):
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                min_size = 2 * (len(buf) - pos)
+                continue
+            if not eof and (end == len(buf) or buf[end] in u'.eE+-0123456789'):  # A number can continue
+                min_size = len(buf) - pos + 1
+                continue
+            min_size = 0
+            pos = end
+            state = 'next'
+            yield item
+        else:
+            raise ValueError(u'Unexpected character {0!r} in JSON array'.format(char))
+
+
+class Operation(object):
+    """Operation of the aggregate, proxied to a microservice."""
+
+    __slots__ = ('name', 'path', 'action', 'api', 'api_url', 'spec', 'url_template', 'retry_policy', 'timeouts',
+                 'cache_ttl', 'coalesce', 'func')
+
+    def __init__(self, name, path, action, api, api_url, spec):
+        """Init the operation.
+
+        Args:
+            name: name of the operation, unique in the aggregate.
+            path: path of the operation.
+            action: http action of the operation.
+            api: name of the api of the operation.
+            api_url: url of the microservice.
+            spec: spec of the operation.
+        """
+        self.name = name
+        self.path = path
+        self.action = action
+        self.api = api
+        self.api_url = api_url
+        self.spec = spec
+        self.url_template = UrlTemplate(api_url, path)
+        self.retry_policy = DEFAULT_RETRY_POLICY
+        self.timeouts = DEFAULT_TIMEOUT_CONFIG
+        self.cache_ttl = None
+        self.coalesce = False
+        self.func = None
+
+
+class OperationTable(object):
+    """Operation functions of the aggregates, by operation name.
+
+    The operationIds of the aggregates are resolved through the attributes
+    of the module level table: swagger_aggregator.operations.<operation name>.
+    """
+
+    def __init__(self):
+        """Init an empty table."""
+        self.functions = {}
+
+    def __getattr__(self, name):
+        """Get the operation function with the given name."""
+        try:
+            return self.__dict__['functions'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+# Dispatcher of the operationIds of the aggregates.
+operations = OperationTable()
+
+
+class UrlTemplate(object):
+    """Url of an operation, compiled once into literal parts and path parameter slots."""
+
+    __slots__ = ('parts',)
+
+    param_regex = re.compile('{([^{}]+)}')
+
+    def __init__(self, base_url, path):
+        """Compile the template.
+
+        Args:
+            base_url: url of the microservice.
+            path: path of the operation, with its parameters between braces.
+        """
+        url = u'{0}{1}'.format(base_url, path)
+        self.parts = []  # List of (literal, path parameter name or None)
+        pos = 0
+        for match in self.param_regex.finditer(url):
+            self.parts.append((url[pos:match.start()], match.group(1)))
+            pos = match.end()
+        self.parts.append((url[pos:], None))
+
+    def expand(self, path_params, query_string=None):
+        """Get the url with the given parameters.
+
+        Args:
+            path_params: dict of path parameters. Missing parameters are left as is.
+            query_string: query string to append to the url.
+
+        Returns:
+            The url.
+        """
+        url = []
+        for literal, param in self.parts:
+            url.append(literal)
+            if param is None:
+                continue
+            if param in path_params:
+                url.append(quote(six.text_type(path_params[param]).encode('utf-8'), safe=''))
+            else:
+                url.append(u'{{{0}}}'.format(param))
+
+        if query_string:
+            if isinstance(query_string, six.text_type):
+                query_string = query_string.encode('utf-8')
+            url.append(u'?')
+            url.append(quote(query_string, safe=QUERY_STRING_SAFE_CHARS))
+        return u''.join(url)
+
+
+class FilterPlan(object):
+    """Compiled filter of the docs following a schema.
+
+    Only the paths of the schema leading to excluded fields are kept.
+    """
+
+    __slots__ = ('exclude', 'properties', 'items', 'values', 'fallback')
+
+    def __init__(self, exclude=(), fallback=False):
+        """Init the plan.
+
+        Args:
+            exclude: keys to remove from the doc.
+            fallback: if True, the doc is filtered by matching its dicts against all definitions.
+        """
+        self.exclude = tuple(exclude)
+        self.properties = {}
+        self.items = None
+        self.values = None
+        self.fallback = fallback
+
+    def children(self):
+        """Get the plans of the sub docs."""
+        children = list(self.properties.values())
+        if self.items is not None:
+            children.append(self.items)
+        if self.values is not None:
+            children.append(self.values)
+        return children
+
+
+# Plan of the docs with an unknown schema.
+STRUCTURAL_FILTER_PLAN = FilterPlan(fallback=True)
+
+
+class ValidatedSwaggerParser(SwaggerParser):
+    """SwaggerParser of a swagger that was already validated.
+
+    Validating a swagger takes nearly all the time of the parsing of a large aggregate,
+    so it is skipped, as well as the parsing of the paths, only the definitions are used.
+    """
+
+    def __init__(self, swagger_dict, use_example=True):
+        """Parse the definitions of a swagger.
+
+        Args:
+            swagger_dict: swagger dict.
+            use_example: use the examples of the swagger in the definition examples.
+        """
+        self.specification = swagger_dict
+        self.use_example = use_example
+        self.base_path = swagger_dict.get('basePath', '')
+        self.definitions_example = {}
+        self.build_definitions_example()
+        self.paths = {}
+        self.operation = {}
+        self.generated_operation = {}
+
+
+class SwaggerAggregator(object):
+    """Create an API from an aggregation of API."""
+
+    def __init__(self, config_file, *args, **kwargs):
+        """Init the aggregation.
+
+        Extra args will be used to replace args in the config file.
+
+        Args:
+            config_file: aggregation config.
+            *args: Arguments indicated at the top of the yaml config file.
+            **kwargs: Other keywords, such as:
+              - timeout (float): Default timeout for get requests in seconds. Defaults to 0.1.
+              - fetch_workers (int): Max number of swagger files fetched concurrently. Defaults to 10.
+              - cache_dir (str): Directory where the swagger files and the aggregate are cached. Defaults to None.
+              - metrics (MetricsSink): Sink receiving the metrics of the operation functions. Defaults to None.
+        """
+        self.config_file = config_file
+        self.swagger_args = args
+        self.errors = []
+        self.swagger_apis = {}
+        self.swagger = None
+        self.serialized_swagger = None
+        self.spec_validators = {}
+        self.sessions = {}
+        self.definitions = {}
+        self.response_index = {}
+        self.definition_plans = {}
+        self.operation_index = None
+        self.path_collisions = []
+        self.api_definitions = {}
+        self.operations = {}
+        self.circuit_breakers = {}
+        self._sessions_lock = threading.Lock()
+        self._update_lock = threading.Lock()
+        self._refresh_thread = None
+        self._refresh_stop = None
+
+        self.timeout = kwargs.get('timeout', 0.1)
+        self.fetch_workers = kwargs.get('fetch_workers', 10)
+        self.cache_dir = kwargs.get('cache_dir')
+        self.metrics = kwargs.get('metrics')
+
+        # Get config
+        with open(self.config_file, 'r') as f:
+            self.yaml_file = yaml.load(f.read(), Loader=YamlLoader)
+
+        self.get_args()
+
+        self.exclude_index = RouteIndex(self.yaml_file.get('exclude_paths', []))
+
+        response_cache = dict(DEFAULT_RESPONSE_CACHE_CONFIG)
+        response_cache.update(self.yaml_file.get('response_cache', {}))
+        self.response_cache = ResponseCache(response_cache['max_entries'])
+        self.single_flight = SingleFlight()
+
+        retry_budget = dict(DEFAULT_RETRY_BUDGET)
+        retry_budget.update(self.yaml_file.get('retry_budget', {}))
+        self.retry_budget = TokenBucket(retry_budget['rate'], retry_budget['capacity'])
+
+    def get_args(self):
+        """Get args of the config file.
+
+        Returns
+            Dict of arg name : arg value
+        """
+        self.args_dict = {}
+        if 'args' in self.yaml_file:  # Check if args category is in the config
+            # Get a list of args
+            args_name = [i.replace(' ', '') for i in self.yaml_file['args'].split(',')]
+
+            # Associate each arg name with a args given in the init.
+            index = 0
+            for arg_name in args_name:
+                self.args_dict[arg_name] = self.swagger_args[index]
+                index += 1
+        return self.args_dict
+
+    def parse_value(self, value):
+        """Replace in the value all args.
+
+        For example if you have an arg 'toto': 'test'
+        and a value: 'http://toto.com'. The function will return
+        'http://test.com'
+
+        Args:
+            value: the str to parse.
+
+        Returns:
+            Parsed value.
+        """
+        if isinstance(value, (six.text_type, six.string_types)):
+            for key in self.args_dict.keys():
+                value = value.replace(key, self.args_dict[key])
+        return value
+
+    @staticmethod
+    def get_api_url(api_config):
+        """Get the url of an api defined in the apis section of the config file.
+
+        An api can either be defined by its url, or by a dict containing
+        its url and its connection pool settings.
+
+        Args:
+            api_config: value of the api in the apis section.
+
+        Returns:
+            The url of the api (args are not replaced).
+        """
+        if isinstance(api_config, dict):
+            return api_config['url']
+        return api_config
+
+    def get_pool_config(self, api_url):
+        """Get the connection pool settings of the api at the given url.
+
+        Settings are taken from DEFAULT_POOL_CONFIG, overridden by the connection_pool
+        section of the config file, overridden by the settings of the api itself.
+
+        Args:
+            api_url: url of the microservice.
+
+        Returns:
+            Dict of pool settings.
+        """
+        pool_config = dict(DEFAULT_POOL_CONFIG)
+        pool_config.update(self.yaml_file.get('connection_pool', {}))
+        for api_config in self.yaml_file.get('apis', {}).values():
+            if isinstance(api_config, dict) and self.parse_value(api_config['url']) == api_url:
+                pool_config.update({k: v for k, v in api_config.items() if k in DEFAULT_POOL_CONFIG})
+        return pool_config
+
+    def get_retry_policy(self, api):
+        """Get the retry policy of the calls to an api.
+
+        Settings are taken from DEFAULT_RETRY_CONFIG, overridden by the retry
+        section of the config file, overridden by the retry section of the api itself.
+
+        Args:
+            api: name of the api.
+
+        Returns:
+            A RetryPolicy.
+        """
+        return RetryPolicy(**self.get_api_section(api, 'retry', DEFAULT_RETRY_CONFIG))
+
+    def get_api_section(self, api, section, defaults):
+        """Get the settings of a section of the config file for an api.
+
+        Settings are taken from the defaults, overridden by the section of the config file,
+        overridden by the section of the api itself.
+
+        Args:
+            api: name of the api.
+            section: name of the section.
+            defaults: dict of default settings.
+
+        Returns:
+            Dict of settings.
+        """
+        config = dict(defaults)
+        config.update(self.yaml_file.get(section, {}))
+        api_config = self.yaml_file.get('apis', {}).get(api)
+        if isinstance(api_config, dict):
+            config.update(api_config.get(section, {}))
+        return config
+
+    def get_operation_config(self, path, action):
+        """Get the settings of an operation in the operations section of the config file.
+
+        Operations are identified like in exclude_paths, e.g. 'GET /pets/{petId}'.
+
+        Args:
+            path: path of the operation.
+            action: http action of the operation.
+
+        Returns:
+            Dict of settings.
+        """
+        for key, config in self.yaml_file.get('operations', {}).items():
+            method, _, operation_path = key.partition(' ')
+            if method.lower() == action and operation_path == path:
+                return config or {}
+        return {}
+
+    def get_timeouts(self, api, path, action):
+        """Get the timeouts of the calls of an operation.
+
+        Settings are taken from the timeouts section of the api, overridden by
+        the timeouts section of the operation in the operations section.
+
+        Args:
+            api: name of the api.
+            path: path of the operation.
+            action: http action of the operation.
+
+        Returns:
+            Dict of timeouts, with connect, read and deadline keys.
+        """
+        timeouts = self.get_api_section(api, 'timeouts', DEFAULT_TIMEOUT_CONFIG)
+        timeouts.update(self.get_operation_config(path, action).get('timeouts', {}))
+        return timeouts
+
+    def get_cache_ttl(self, path, action):
+        """Get the time the responses of an operation are cached.
+
+        Only GET operations with a cache key in the operations section are cached.
+        The key is either true, for DEFAULT_CACHE_TTL, or a dict with a ttl key.
+
+        Args:
+            path: path of the operation.
+            action: http action of the operation.
+
+        Returns:
+            Time to live in seconds, None if the responses are not cached.
+        """
+        cache_config = self.get_operation_config(path, action).get('cache')
+        if action != 'get' or not cache_config:
+            return None
+        if isinstance(cache_config, dict):
+            return cache_config.get('ttl', DEFAULT_CACHE_TTL)
+        return DEFAULT_CACHE_TTL
+
+    def get_coalesce(self, path, action):
+        """Check if the identical concurrent calls of an operation share the same upstream call.
+
+        Only GET operations are coalesced, when the coalesce_requests setting or
+        the coalesce key of the operation in the operations section is true.
+
+        Args:
+            path: path of the operation.
+            action: http action of the operation.
+
+        Returns:
+            True if the calls are coalesced.
+        """
+        if action != 'get':
+            return False
+        default = self.yaml_file.get('coalesce_requests', False)
+        return bool(self.get_operation_config(path, action).get('coalesce', default))
+
+    def get_circuit_breaker(self, api):
+        """Get the circuit breaker of the calls to an api.
+
+        Args:
+            api: name of the api.
+
+        Returns:
+            A CircuitBreaker.
+        """
+        breaker = self.circuit_breakers.get(api)
+        if breaker is None:
+            with self._sessions_lock:
+                breaker = self.circuit_breakers.get(api)
+                if breaker is None:
+                    breaker = CircuitBreaker(**self.get_api_section(api, 'circuit_breaker',
+                                                                    DEFAULT_CIRCUIT_BREAKER_CONFIG))
+                    self.circuit_breakers[api] = breaker
+        return breaker
+
+    def get_circuit_states(self):
+        """Get the status of the circuit breakers, for monitoring.
+
+        Returns:
+            Dict of api name: status of its circuit breaker.
+        """
+        return {api: breaker.get_status() for api, breaker in list(self.circuit_breakers.items())}
+
+    @staticmethod
+    def get_circuit_open_error(api, breaker):
+        """Get the error returned while the circuit of an api is open.
+
+        Args:
+            api: name of the api.
+            breaker: CircuitBreaker of the api.
+
+        Returns:
+            (error doc, 503, headers)
+        """
+        return ({'message': 'Service {0} is unavailable'.format(api)}, 503,
+                {'Retry-After': str(int(math.ceil(breaker.get_retry_after())))})
+
+    def get_session(self, api_url):
+        """Get the keep-alive session used to call the microservice at the given url.
+
+        Sessions are shared by all the operations targeting the same url.
+
+        Args:
+            api_url: url of the microservice.
+
+        Returns:
+            A requests.Session.
+        """
+        with self._sessions_lock:
+            if api_url not in self.sessions:
+                pool_config = self.get_pool_config(api_url)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=pool_config['pool_connections'],
+                                      pool_maxsize=pool_config['pool_maxsize'],
+                                      pool_block=pool_config['pool_block'])
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                if not pool_config['keep_alive']:
+                    session.headers['Connection'] = 'close'
+                self.sessions[api_url] = session
+            return self.sessions[api_url]
+
+    def get_swagger_from_url(self, api_url):
+        """Get the swagger file of the microservice at the given url.
+
+        Args:
+            api_url: url of the microservice.
+        """
+        self.spec_validators.pop(api_url, None)
+        return self.get_swagger_if_modified(api_url)
+
+    def get_swagger_if_modified(self, api_url):
+        """Get the swagger file of the microservice at the given url if it changed since it was last fetched.
+
+        The request is conditional on the ETag and Last-Modified of the last response.
+        A new response with the same content hash as the last one is not parsed.
+
+        Args:
+            api_url: url of the microservice.
+
+        Returns:
+            The swagger spec, or None if it did not change.
+        """
+        validators = self.spec_validators.get(api_url, {})
+        headers = {}
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last_modified' in validators:
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        req = requests.get('{0}/swagger.json'.format(self.parse_value(api_url)), headers=headers, timeout=self.timeout)
+        if req.status_code == 304:
+            return None
+
+        content_hash = hashlib.sha1(req.content).hexdigest()
+        spec = None if content_hash == validators.get('hash') else req.json()
+
+        validators = {
+            'etag': req.headers.get('ETag'),
+            'last_modified': req.headers.get('Last-Modified'),
+            'hash': content_hash
+        }
+        self.spec_validators[api_url] = {k: v for k, v in validators.items() if v}
+        return spec
 
-def retry_http(call):
-    """Wrapper used to retry HTTP Errors with an exponential backoff
+    def fetch_swagger(self, api_url, if_modified=False):
+        """Get the swagger file of the microservice at the given url without raising on HTTP errors.
 
-    Args:
-        call: function being wrapped
+        Args:
+            api_url: url of the microservice.
+            if_modified: only get the swagger file if it changed since it was last fetched.
 
-    Returns:
-        the wrapped function
-    """
+        Returns:
+            (swagger spec, None) on success, (None, exception) on error.
+            The spec is None if if_modified is set and it did not change.
+        """
+        try:
+            if if_modified:
+                return self.get_swagger_if_modified(api_url), None
+            return self.get_swagger_from_url(api_url), None
+        except (JSONDecodeError, RequestException) as exc:
+            return None, exc
 
-    def _retry_http(*args, **kwargs):
-        """Retry a function call when catching requests.exceptions.RequestException"""
-        last_exception = None
-        multiplier = 1.5
-        retry_interval = 0.5
-        randomization_factor = 0.5
-        total_sleep_time = 0
-        # Capped to 10 seconds
-        max_sleep_time = 10
-
-        request_nb = 0
-        while total_sleep_time < max_sleep_time:
-            try:
-                return call(*args, **kwargs)
-            except ConnectionError as exc:
-                # Inspired from https://developers.google.com/api-client-library/java/google-http-java-client/reference/
-                # 1.20.0/com/google/api/client/util/ExponentialBackOff
-                next_retry_sleep = (multiplier ** request_nb * (retry_interval *
-                                    (random.randint(0, int(2 * randomization_factor * 1000)) / 1000. + 1 - randomization_factor)))
-
-                total_sleep_time += next_retry_sleep
-                request_nb += 1
-
-                last_exception = exc
-                logger.warning('Got an exception: {exc}. Slept ({retry} seconds / {total} seconds)'
-                               .format(exc=exc,
-                                       retry=total_sleep_time,
-                                       total=max_sleep_time))
-                time.sleep(next_retry_sleep)
-        logger.error('Max sleep time exceeded, raising exception.')
-        raise last_exception
+    def fetch_swaggers(self, api_urls, if_modified=False):
+        """Get the swagger files of the microservices at the given urls concurrently.
 
-    # Keep the doc
-    _retry_http.__doc__ += call.__doc__
+        At most fetch_workers files are fetched at a time.
 
-    return _retry_http
+        Args:
+            api_urls: urls of the microservices.
+            if_modified: only get the swagger files that changed since they were last fetched.
 
+        Returns:
+            List of (swagger spec, exception), see fetch_swagger.
+        """
+        max_workers = min(self.fetch_workers, len(api_urls))
+        if max_workers > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                return list(executor.map(lambda api_url: self.fetch_swagger(api_url, if_modified), api_urls))
+        return [self.fetch_swagger(api_url, if_modified) for api_url in api_urls]
 
-class SwaggerAggregator(object):
-    """Create an API from an aggregation of API."""
+    def set_api_error(self, api_url, exc=None):
+        """Add or remove an api from the errors.
 
-    def __init__(self, config_file, *args, **kwargs):
-        """Init the aggregation.
+        Args:
+            api_url: url of the api.
+            exc: exception raised when getting the api swagger, None if there was none.
+        """
+        if exc is None:
+            try:
+                self.errors.remove(api_url)
+            except ValueError:
+                logger.info(u'Cannot remove {0} from errors'.format(api_url))
+        else:
+            if api_url not in self.errors:
+                self.errors.append(api_url)
+            logger.warning(u'Cannot get swagger from {0}: {1}'.format(api_url, repr(exc)))
 
-        Extra args will be used to replace args in the config file.
+    def get_aggregate_swagger(self):
+        """Get swagger files associated with the aggregates.
 
-        Args:
-            config_file: aggregation config.
-            *args: Arguments indicated at the top of the yaml config file.
-            **kwargs: Other keywords, such as:
-              - timeout (float): Default timeout for get requests in seconds. Defaults to 0.1.
+        Swagger files are fetched concurrently, at most fetch_workers at a time.
+
+        Returns:
+            A dict of swagger spec.
         """
-        self.config_file = config_file
-        self.swagger_args = args
-        self.errors = []
-        self.swagger_apis = {}
+        if 'apis' in self.yaml_file:  # Check if apis is in the config file
+            apis = [(api_name, self.get_api_url(api_config)) for api_name, api_config in self.yaml_file['apis'].items()
+                    if api_name not in self.swagger_apis]
+
+            # Get the swagger.json
+            results = self.fetch_swaggers([api_url for _, api_url in apis])
+
+            for (api_name, api_url), (spec, exc) in zip(apis, results):
+                if exc is None:
+                    self.swagger_apis[api_name] = {'spec': spec,
+                                                   'url': self.parse_value(api_url)}
+                    self.save_api_cache(api_name, api_url)
+                elif self.cache_dir is not None:
+                    # Keep serving the api from the cache
+                    spec = self.load_api_cache(api_name, api_url)
+                    if spec is not None:
+                        logger.warning(u'Using cached swagger of {0}'.format(api_url))
+                        self.swagger_apis[api_name] = {'spec': spec,
+                                                       'url': self.parse_value(api_url)}
+                self.set_api_error(api_url, exc)
+        return self.swagger_apis
 
-        self.timeout = kwargs.get('timeout', 0.1)
+    def refresh_apis(self):
+        """Refresh the apis whose swagger file changed since it was last fetched.
 
-        # Get config
-        with open(self.config_file, 'r') as f:
-            self.yaml_file = yaml.load(f.read())
+        Unchanged swagger files are not downloaded again when the microservice supports
+        conditional requests, and are not merged again when their content hash did not change.
+        If the aggregate was already generated, the changed apis are updated in it with update_api.
 
-        self.get_args()
+        Returns:
+            List of the names of the updated apis.
+        """
+        apis = [(api_name, self.get_api_url(api_config)) for api_name, api_config in self.yaml_file.get('apis', {}).items()]
+        results = self.fetch_swaggers([api_url for _, api_url in apis], if_modified=True)
+
+        updated_apis = []
+        with self._update_lock:
+            for (api_name, api_url), (spec, exc) in zip(apis, results):
+                if exc is None and api_url in self.errors:
+                    self.set_api_error(api_url)
+                elif exc is not None:
+                    self.set_api_error(api_url, exc)
+                if spec is None:
+                    continue
+
+                if self.swagger is not None:
+                    self.update_api(api_name, spec, self.parse_value(api_url))
+                else:
+                    self.swagger_apis[api_name] = {'spec': spec, 'url': self.parse_value(api_url)}
+                self.save_api_cache(api_name, api_url)
+                updated_apis.append(api_name)
+        return updated_apis
+
+    def get_api_cache_path(self, api_name, api_url):
+        """Get the path of the cached swagger of an api.
 
-    def get_args(self):
-        """Get args of the config file.
+        Args:
+            api_name: name of the api.
+            api_url: url of the api.
 
-        Returns
-            Dict of arg name : arg value
+        Returns:
+            Path of the cache file.
         """
-        self.args_dict = {}
-        if 'args' in self.yaml_file:  # Check if args category is in the config
-            # Get a list of args
-            args_name = [i.replace(' ', '') for i in self.yaml_file['args'].split(',')]
+        url_hash = hashlib.sha1(self.parse_value(api_url).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.cache_dir, u'api-{0}-{1}.json'.format(api_name, url_hash))
 
-            # Associate each arg name with a args given in the init.
-            index = 0
-            for arg_name in args_name:
-                self.args_dict[arg_name] = self.swagger_args[index]
-                index += 1
-        return self.args_dict
+    def save_api_cache(self, api_name, api_url):
+        """Cache the swagger of an api on disk, with its validators.
 
-    def parse_value(self, value):
-        """Replace in the value all args.
+        Args:
+            api_name: name of the api.
+            api_url: url of the api.
+        """
+        if self.cache_dir is None:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
 
-        For example if you have an arg 'toto': 'test'
-        and a value: 'http://toto.com'. The function will return
-        'http://test.com'
+        cache = {'url': self.parse_value(api_url),
+                 'validators': self.spec_validators.get(api_url, {}),
+                 'spec': self.swagger_apis[api_name]['spec']}
+        try:
+            write_file_atomic(self.get_api_cache_path(api_name, api_url), json.dumps(cache).encode('utf-8'), 0o600)
+        except (IOError, OSError) as exc:
+            logger.warning(u'Cannot cache swagger of {0}: {1}'.format(api_url, repr(exc)))
+
+    def load_api_cache(self, api_name, api_url):
+        """Load the cached swagger of an api.
+
+        The validators of the cached swagger are restored, so it can be revalidated with refresh_apis.
 
         Args:
-            value: the str to parse.
+            api_name: name of the api.
+            api_url: url of the api.
 
         Returns:
-            Parsed value.
+            The cached swagger spec, or None if it is not cached.
         """
-        if isinstance(value, (six.text_type, six.string_types)):
-            for key in self.args_dict.keys():
-                value = value.replace(key, self.args_dict[key])
-        return value
+        try:
+            with open(self.get_api_cache_path(api_name, api_url), 'rb') as f:
+                cache = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return None
+        if cache.get('url') != self.parse_value(api_url):
+            return None
 
-    def get_swagger_from_url(self, api_url):
-        """Get the swagger file of the microservice at the given url.
+        self.spec_validators.setdefault(api_url, cache.get('validators', {}))
+        return cache['spec']
+
+    def load_cache(self):
+        """Load the cached swagger of the apis not fetched yet.
+
+        Combined with the cached aggregate, the swagger can be generated without calling any microservice.
+        The loaded apis can then be revalidated with refresh_apis or start_refresh.
+
+        Returns:
+            List of the names of the loaded apis.
+        """
+        loaded_apis = []
+        if self.cache_dir is None:
+            return loaded_apis
+        for api_name, api_config in self.yaml_file.get('apis', {}).items():
+            if api_name not in self.swagger_apis:
+                api_url = self.get_api_url(api_config)
+                spec = self.load_api_cache(api_name, api_url)
+                if spec is not None:
+                    self.swagger_apis[api_name] = {'spec': spec, 'url': self.parse_value(api_url)}
+                    loaded_apis.append(api_name)
+        return loaded_apis
+
+    def get_aggregate_cache_key(self):
+        """Get the key of the aggregate of the current apis.
+
+        The key depends on the config and on the content hash of every api swagger.
+
+        Returns:
+            The key, or None if the content hash of an api is unknown.
+        """
+        apis = {}
+        for api_name, api_config in self.yaml_file.get('apis', {}).items():
+            if api_name in self.swagger_apis:
+                content_hash = self.spec_validators.get(self.get_api_url(api_config), {}).get('hash')
+                if content_hash is None:
+                    return None
+                apis[api_name] = [self.swagger_apis[api_name]['url'], content_hash]
+        key = json.dumps({'apis': apis, 'config': self.yaml_file}, sort_keys=True, default=repr)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def save_aggregate_cache(self, swagger):
+        """Cache the merged aggregate on disk, with its operation index.
 
         Args:
-            api_url: url of the microservice.
+            swagger: merged swagger spec, without its excluded paths.
         """
-        return requests.get('{0}/swagger.json'.format(self.parse_value(api_url)), timeout=self.timeout).json()
+        key = self.get_aggregate_cache_key()
+        if self.cache_dir is None or key is None:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        cache = {
+            'key': key,
+            'swagger': swagger,
+            'operation_index': [[path, action, api_url, api]
+                                for (path, action), (_, api_url, api) in self.operation_index.items()],
+            'api_definitions': self.api_definitions,
+            'path_collisions': self.path_collisions
+        }
+        try:
+            write_file_atomic(os.path.join(self.cache_dir, 'aggregate.json'), json.dumps(cache).encode('utf-8'), 0o600)
+        except (IOError, OSError) as exc:
+            logger.warning(u'Cannot cache aggregate: {0}'.format(repr(exc)))
 
-    def get_aggregate_swagger(self):
-        """Get swagger files associated with the aggregates.
+    def load_aggregate_cache(self):
+        """Load the cached aggregate of the current apis.
 
         Returns:
-            A dict of swagger spec.
+            The merged swagger spec without its excluded paths, or None if it is not cached.
         """
-        if 'apis' in self.yaml_file:  # Check if apis is in the config file
-            for api_name, api_url in self.yaml_file['apis'].items():
-                if api_name not in self.swagger_apis:
-                    # Get the swagger.json
-                    try:
-                        self.swagger_apis[api_name] = {'spec': self.get_swagger_from_url(api_url),
-                                                       'url': self.parse_value(api_url)}
-                        self.errors.remove(api_url)
-                    except (JSONDecodeError, RequestException) as exc:
-                        if api_url not in self.errors:
-                            self.errors.append(api_url)
-                        logger.warning(u'Cannot get swagger from {0}: {1}'.format(api_url, repr(exc)))
-                    except ValueError:
-                        logger.info(u'Cannot remove {0} from errors'.format(api_url))
-        return self.swagger_apis
+        key = self.get_aggregate_cache_key()
+        if self.cache_dir is None or key is None:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir, 'aggregate.json'), 'rb') as f:
+                cache = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return None
+        if cache.get('key') != key:
+            return None
+
+        swagger = cache['swagger']
+        self.operation_index = {}
+        for path, action, api_url, api in cache['operation_index']:
+            operation_spec = swagger['paths'].get(path, {}).get(action)
+            if operation_spec is not None:
+                self.operation_index[(path, action)] = (operation_spec, api_url, api)
+        self.api_definitions = cache['api_definitions']
+        self.path_collisions = cache['path_collisions']
+        return swagger
+
+    def start_refresh(self, interval):
+        """Refresh the apis in a background thread.
+
+        Args:
+            interval: time between two refreshes in seconds.
+        """
+        self.stop_refresh()
+
+        stop_event = threading.Event()
+
+        def refresh():
+            while not stop_event.wait(interval):
+                try:
+                    self.refresh_apis()
+                except Exception:
+                    logger.exception('Cannot refresh apis')
+
+        self._refresh_stop = stop_event
+        self._refresh_thread = threading.Thread(target=refresh, name='swagger-aggregator-refresh')
+        self._refresh_thread.daemon = True
+        self._refresh_thread.start()
+
+    def stop_refresh(self):
+        """Stop the background refresh of the apis."""
+        if self._refresh_thread is not None:
+            self._refresh_stop.set()
+            self._refresh_thread.join()
+            self._refresh_thread = None
+            self._refresh_stop = None
 
     def exclude_paths(self, swagger):
         """Exclude path in the given swagger.
 
         Path to exclude are definded in the exclude_paths section of the config file.
+        They are already excluded from the merged apis, this is for other specs.
 
         Args:
             swagger: dict of swagger spec.
@@ -175,41 +1800,93 @@ class SwaggerAggregator(object):
         Returns:
             Swagger spec without the excluded paths.
         """
-        # Get exclude_paths
-        path_exclude = {p.split(' ')[1]: [p.split(' ')[0].lower()] for p in self.yaml_file.get('exclude_paths', [])}
-
-        # Remove excluded paths
-        swagger_filtered = deepcopy(swagger)
+        # Remove excluded paths, only the modified path items are copied
+        swagger_filtered = dict(swagger)
+        swagger_filtered['paths'] = dict(swagger['paths'])
         for path, path_spec in swagger['paths'].items():
-            if path in path_exclude.keys():
-                for action, _ in path_spec.items():
-                    if action in path_exclude[path]:
-                        del swagger_filtered['paths'][path][action]
+            excluded_methods = self.exclude_index.get_methods(path)
+            if excluded_methods:
+                swagger_filtered['paths'][path] = {action: action_spec for action, action_spec in path_spec.items()
+                                                   if action not in excluded_methods}
         return swagger_filtered
 
-    def merge_aggregates(self, swagger):
+    def merge_api(self, api, api_spec, swagger):
+        """Merge an api in the given swagger.
+
+        Args:
+            api: name of the api.
+            api_spec: dict with the spec and the url of the api.
+            swagger: swagger spec to merge the api in.
+        """
+        # Rename definition to avoid collision.
+        # Only the parts of the spec containing a reference are copied.
+        spec = namespace_refs(api_spec['spec'], api)
+
+        self.api_definitions[api] = []
+        for definition_name, definition_spec in spec.get('definitions', {}).items():
+            if not definition_name.startswith(api):
+                definition_name = u'{0}{1}'.format(api, definition_name)
+            swagger['definitions'][definition_name] = definition_spec
+            self.api_definitions[api].append(definition_name)
+
+        if 'paths' in spec:
+            self.index_operations(api, api_spec['url'], spec['paths'], swagger['paths'])
+
+    def merge_aggregates(self, swagger, swagger_apis=None):
         """Merge aggregates.
 
+        The (path, action) -> (operation spec, microservice url, api name) index
+        of the merged operations is built in operation_index.
+
         Args:
             swagger: swagger spec to merge apis in.
+            swagger_apis: dict of swagger spec to merge. Defaults to get_aggregate_swagger().
 
         Returns:
             Aggregate of all apis.
         """
-        swagger_apis = deepcopy(self.get_aggregate_swagger())
+        self.operation_index = {}
+        self.path_collisions = []
+        self.api_definitions = {}
+
+        if swagger_apis is None:
+            swagger_apis = self.get_aggregate_swagger()
         for api, api_spec in swagger_apis.items():
-            # Rename definition to avoid collision.
-            api_spec['spec'] = json.loads(json.dumps(api_spec['spec']).replace('#/definitions/', u'#/definitions/{0}'.format(api)))
+            self.merge_api(api, api_spec, swagger)
 
-            if 'definitions' in api_spec['spec']:
-                for definition_name, definition_spec in api_spec['spec']['definitions'].items():
-                    if not definition_name.startswith(api):
-                        swagger['definitions'][u'{0}{1}'.format(api, definition_name)] = definition_spec
-                    else:
-                        swagger['definitions'][definition_name] = definition_spec
+    def index_operations(self, api, api_url, paths, swagger_paths=None):
+        """Add the operations of an api to the operation index.
 
-            if 'paths' in api_spec['spec']:
-                swagger['paths'].update(deepcopy(api_spec['spec']['paths']))
+        Operations already defined by another api are replaced, the collision is logged
+        and added to path_collisions. Operations excluded by exclude_paths are skipped.
+
+        Args:
+            api: name of the api.
+            api_url: url of the api.
+            paths: paths of the api spec.
+            swagger_paths: if given, paths of the swagger spec to merge the operations in.
+        """
+        for path_name, path_spec in paths.items():
+            excluded_methods = self.exclude_index.get_methods(path_name)
+            for key, value in path_spec.items():
+                if key not in HTTP_METHODS:
+                    if swagger_paths is not None:
+                        swagger_paths.setdefault(path_name, {})[key] = value
+                    continue
+                if key in excluded_methods:
+                    continue
+
+                if (path_name, key) in self.operation_index:
+                    collision = {'path': path_name, 'action': key,
+                                 'api': api, 'replaced_api': self.operation_index[(path_name, key)][2]}
+                    self.path_collisions.append(collision)
+                    logger.warning(u'{action} {path} of {replaced_api} is replaced by the one of {api}'.format(**collision))
+
+                if swagger_paths is not None:
+                    # Copied as its operationId is changed
+                    value = dict(value)
+                    swagger_paths.setdefault(path_name, {})[key] = value
+                self.operation_index[(path_name, key)] = (value, api_url, api)
 
     def generate_swagger_json(self):
         """Generate a swagger from all the apis swagger."""
@@ -223,54 +1900,425 @@ class SwaggerAggregator(object):
         }
 
         # Merge aggregates
-        self.merge_aggregates(base_swagger)
+        swagger_apis = self.get_aggregate_swagger()
+        cached_swagger = self.load_aggregate_cache()
+        if cached_swagger is not None:
+            base_swagger = cached_swagger
+        else:
+            self.merge_aggregates(base_swagger, swagger_apis)
 
-        base_swagger = self.exclude_paths(base_swagger)
+        # Index the definitions each response can contain
+        self.definitions = dict(base_swagger['definitions'])
 
-        # Change operation id
-        spec = {}
-        uri = {}
-        path_list = {}
-        action_list = {}
-        current_module = sys.modules[__name__]
-        for path, path_spec in base_swagger['paths'].items():
-            for action, action_spec in path_spec.items():
-                # Generate function name and get spec and api url for the path
-                func_name = uuid()
-                path_list[func_name] = path
-                action_list[func_name] = action
-                spec[func_name], uri[func_name] = self.get_spec_from_uri(path, action)
+        # Only validated aggregates are cached, so a cached one is not validated again
+        swagger_parser = self.create_swagger_parser(base_swagger, validate=cached_swagger is None)
+        if cached_swagger is None:
+            self.save_aggregate_cache(base_swagger)
+        self.response_index = {}
+
+        # Change operation id, the operations of the previous generation are released
+        for path, action in list(self.operations.keys()):
+            self.remove_operation(path, action)
+        self.response_cache.clear()
+        self.generate_operations(base_swagger['paths'])
+
+        self.compile_filter_plans()
+
+        self.swagger = base_swagger
+        self.swagger_parser = swagger_parser
+
+        self.exclude_definition_fields(base_swagger['definitions'])
+
+        self.serialized_swagger = SerializedSwagger(base_swagger)
+        self.write_swagger(base_swagger)
+
+    def update_api(self, api, spec, api_url=None):
+        """Update the aggregate with a new spec of one of its apis.
+
+        Only the paths, definitions and operation functions of this api are replaced,
+        the ones of the other apis are kept as they are.
+        generate_swagger_json must have been called before.
+
+        Args:
+            api: name of the api.
+            spec: new swagger spec of the api.
+            api_url: url of the api. Defaults to its current url.
+        """
+        if api_url is None:
+            api_url = self.swagger_apis[api]['url'] if api in self.swagger_apis else \
+                self.parse_value(self.get_api_url(self.yaml_file['apis'][api]))
+        self.swagger_apis[api] = {'spec': spec, 'url': api_url}
+
+        # Remove the current operations and definitions of the api
+        for (path, action), (_, _, operation_api) in list(self.operation_index.items()):
+            if operation_api == api:
+                del self.operation_index[(path, action)]
+                self.remove_operation(path, action)
+                path_spec = self.swagger['paths'].get(path, {})
+                path_spec.pop(action, None)
+                if not any(key in HTTP_METHODS for key in path_spec):
+                    self.swagger['paths'].pop(path, None)
+        removed_definitions = self.api_definitions.pop(api, [])
+        for definition_name in removed_definitions:
+            self.swagger['definitions'].pop(definition_name, None)
+            self.definitions.pop(definition_name, None)
+            self.definition_plans.pop(definition_name, None)
+
+        # Merge the new spec
+        api_swagger = {'definitions': {}, 'paths': {}}
+        self.merge_api(api, self.swagger_apis[api], api_swagger)
+
+        self.definitions.update(api_swagger['definitions'])
+        self.swagger['definitions'].update(api_swagger['definitions'])
+        for path, path_spec in api_swagger['paths'].items():
+            self.swagger['paths'].setdefault(path, {}).update(path_spec)
+
+        names = self.generate_operations(api_swagger['paths'])
+        self.compile_filter_plans(names)
+
+        self.update_parser_definitions(set(removed_definitions) | set(api_swagger['definitions']))
+
+        self.exclude_definition_fields(self.swagger['definitions'], api_swagger['definitions'].keys())
+
+        self.serialized_swagger = SerializedSwagger(self.swagger)
+        self.write_swagger(self.swagger)
+
+    def generate_operations(self, paths):
+        """Generate the operation functions of the given paths and set their operationId.
+
+        Args:
+            paths: swagger paths.
 
-                # Export generated function to a module level function
-                setattr(current_module, func_name, self.generate_operation_id_function(spec, uri, path_list, action_list, func_name))
+        Returns:
+            List of the names of the generated operations.
+        """
+        names = []
+        for path, path_spec in paths.items():
+            for action, action_spec in path_spec.items():
+                if action not in HTTP_METHODS:
+                    continue
+
+                # Replaced operation
+                self.remove_operation(path, action)
+
+                # Get spec and api url for the path
+                name = self.get_operation_name(path, action)
+                spec, api_url = self.get_spec_from_uri(path, action)
+                operation = Operation(name, path, action, self.operation_index[(path, action)][2], api_url, spec)
+                operation.retry_policy = self.get_retry_policy(operation.api)
+                operation.timeouts = self.get_timeouts(operation.api, path, action)
+                operation.cache_ttl = self.get_cache_ttl(path, action)
+                operation.coalesce = self.get_coalesce(path, action)
+                operation.func = self.generate_operation_id_function(operation)
+                self.operations[(path, action)] = operation
+                operations.functions[name] = operation.func
 
                 # Set operationId
-                action_spec['operationId'] = 'swagger_aggregator.{0}'.format(func_name)
+                action_spec['operationId'] = 'swagger_aggregator.operations.{0}'.format(name)
+
+                self.response_index[name] = self.get_response_index(action_spec)
+                names.append(name)
+        return names
+
+    @staticmethod
+    def get_operation_name(path, action):
+        """Get a stable name for an operation, derived from its action and path.
+
+        Args:
+            path: path of the operation.
+            action: http action of the operation.
+
+        Returns:
+            The name of the operation, unique among the generated operations.
+        """
+        name = u'{0}_{1}'.format(action, re.sub('[^0-9a-zA-Z]+', '_', path).strip('_') or 'root')
+        unique_name = name
+        index = 2
+        while unique_name in operations.functions:
+            unique_name = u'{0}_{1}'.format(name, index)
+            index += 1
+        return unique_name
+
+    def remove_operation(self, path, action):
+        """Remove the operation of the given path and action.
+
+        Args:
+            path: path of the operation.
+            action: http action of the operation.
+        """
+        operation = self.operations.pop((path, action), None)
+        if operation is None:
+            return
+
+        if operations.functions.get(operation.name) is operation.func:
+            del operations.functions[operation.name]
+        self.response_index.pop(operation.name, None)
+
+    def create_swagger_parser(self, swagger, validate=True):
+        """Create the swagger parser used to match docs against the definitions.
+
+        Args:
+            swagger: aggregated swagger.
+            validate: False if the swagger was already validated.
+
+        Returns:
+            A SwaggerParser.
+        """
+        # The parser keeps the definitions with their excluded fields
+        swagger_dict = dict(swagger, definitions=self.definitions)
+        if not validate:
+            return ValidatedSwaggerParser(swagger_dict)
+
+        # The validator annotates the references it resolves, so a copy is validated
+        parser = SwaggerParser(swagger_dict=copy.deepcopy(swagger_dict))
+        parser.specification = swagger_dict
+        return parser
+
+    def update_parser_definitions(self, definition_names):
+        """Update the swagger parser with the definitions that changed since it was created.
+
+        The parser shares self.definitions, so only the examples of the changed definitions
+        are rebuilt, and the aggregate is not validated again.
+
+        Args:
+            definition_names: names of the added, replaced or removed definitions.
+        """
+        definitions_example = self.swagger_parser.definitions_example
+        for definition_name in definition_names:
+            definitions_example.pop(definition_name, None)
+        for definition_name in definition_names:
+            if definition_name in self.definitions:
+                self.swagger_parser.build_one_definition_example(definition_name)
+
+    def exclude_definition_fields(self, definitions, definition_names=None):
+        """Remove the fields defined in the exclude_fields section of the config file from definitions.
+
+        The modified definitions are copied.
+
+        Args:
+            definitions: dict of definitions.
+            definition_names: names of the definitions to update. Defaults to all.
+        """
+        for definition_name, keys in self.yaml_file.get('exclude_fields', {}).items():
+            if definition_name in definitions and (definition_names is None or definition_name in definition_names):
+                definition_spec = dict(definitions[definition_name])
+                if 'required' in definition_spec:
+                    definition_spec['required'] = [key for key in definition_spec['required'] if key not in keys]
+                if 'properties' in definition_spec:
+                    definition_spec['properties'] = {k: v for k, v in definition_spec['properties'].items() if k not in keys}
+                definitions[definition_name] = definition_spec
+
+    def get_output_config(self):
+        """Get the settings of the file the aggregated swagger is written to.
+
+        Settings are taken from DEFAULT_OUTPUT_CONFIG, overridden by the output section
+        of the config file. The output section can also be false to not write any file.
+
+        Returns:
+            Dict of output settings, None if no file is written.
+        """
+        output = self.yaml_file.get('output', {})
+        if output is False or output is None:
+            return None
+        output_config = dict(DEFAULT_OUTPUT_CONFIG)
+        output_config.update(output)
+        if output_config['format'] in (None, 'none'):
+            return None
+        if output_config['format'] not in SWAGGER_SERIALIZERS:
+            raise ValueError(u'Unknown output format {0}'.format(output_config['format']))
+        return output_config
+
+    def get_serialized_swagger(self):
+        """Get the aggregated swagger serialized in JSON.
+
+        It is serialized once per generation, and replaced as a whole by the next one.
+        generate_swagger_json must have been called before.
+
+        Returns:
+            A SerializedSwagger.
+        """
+        return self.serialized_swagger
+
+    def swagger_json_view(self):
+        """Flask view serving the aggregated swagger in JSON.
+
+        Returns:
+            A flask.Response, 304 if the client already has the swagger.
+        """
+        body, status, headers = self.get_serialized_swagger().get_response(flask.request.headers)
+        return flask.Response(body, status=status, headers=headers)
+
+    def register_swagger_json(self, app, rule='/swagger.json'):
+        """Serve the aggregated swagger in JSON from a flask app.
+
+        Args:
+            app: flask.Flask app.
+            rule: url rule of the swagger.
+        """
+        app.add_url_rule(rule, 'swagger_aggregator_swagger_json', self.swagger_json_view, methods=['GET'])
+
+    def write_swagger(self, swagger):
+        """Write the aggregated swagger as configured in the output section.
+
+        By default it is written in swagger.yaml, next to the config file.
+        The file is replaced atomically.
+
+        Args:
+            swagger: aggregated swagger spec.
+        """
+        output_config = self.get_output_config()
+        if output_config is None:
+            return
+
+        extension, serializer = SWAGGER_SERIALIZERS[output_config['format']]
+        data = serializer(swagger, output_config['minify'])
+        path = output_config['path']
+        if path is None:
+            path = os.path.join(os.path.dirname(os.path.realpath(self.config_file)), 'swagger.' + extension)
+        if output_config['gzip']:
+            data = gzip_bytes(data)
+            if not path.endswith('.gz'):
+                path += '.gz'
+        write_file_atomic(path, data)
+
+    @staticmethod
+    def get_definition_name(schema):
+        """Get the name of the definition referenced by the given schema.
+
+        Args:
+            schema: schema to check.
+
+        Returns:
+            The definition name, or None if the schema is not a reference.
+        """
+        if isinstance(schema, dict) and isinstance(schema.get('$ref'), six.string_types):
+            return schema['$ref'].split('/')[-1]
+        return None
+
+    def get_response_index(self, action_spec):
+        """Index the response schemas of an action.
+
+        Args:
+            action_spec: spec of the action.
 
-        self.swagger_parser = SwaggerParser(swagger_dict=deepcopy(base_swagger))
+        Returns:
+            Dict of status code: {'schema': response schema}
+        """
+        response_index = {}
+        for status_code, response_spec in action_spec.get('responses', {}).items():
+            if isinstance(response_spec, dict) and response_spec.get('schema') is not None:
+                response_index[str(status_code)] = {'schema': response_spec['schema']}
+        return response_index
+
+    def compile_filter_plan(self, schema, plans):
+        """Compile the filter plan of the given schema.
+
+        Plans of the definitions are shared, so the returned plan can be recursive.
+
+        Args:
+            schema: schema to compile.
+            plans: list every created plan is appended to.
+
+        Returns:
+            A FilterPlan.
+        """
+        definition_name = self.get_definition_name(schema)
+        if definition_name is not None:
+            if definition_name in self.definition_plans:
+                return self.definition_plans[definition_name]
+            schema = self.definitions.get(definition_name)
+            plan = FilterPlan(self.yaml_file.get('exclude_fields', {}).get(definition_name, []))
+            self.definition_plans[definition_name] = plan
+        else:
+            plan = FilterPlan()
+        plans.append(plan)
+
+        if not isinstance(schema, dict) or any(key in schema for key in AMBIGUOUS_SCHEMA_KEYS):
+            plan.fallback = True
+        elif 'properties' in schema:
+            for key, property_spec in schema['properties'].items():
+                plan.properties[key] = self.compile_filter_plan(property_spec, plans)
+        elif isinstance(schema.get('additionalProperties'), dict):
+            plan.values = self.compile_filter_plan(schema['additionalProperties'], plans)
+        elif isinstance(schema.get('items'), dict):
+            plan.items = self.compile_filter_plan(schema['items'], plans)
+        elif schema.get('type') in (None, 'object', 'array'):  # Free-form doc
+            plan.fallback = True
+        return plan
+
+    def compile_filter_plans(self, names=None):
+        """Compile the filter plan of the responses in the response index.
+
+        Plans are pruned of the paths that do not lead to excluded fields.
+        The plan of a response is None if nothing has to be filtered in it.
 
-        # Remove exclude_fields from swagger
-        for definition_name, definition_spec in base_swagger['definitions'].items():
-            if definition_name in self.yaml_file.get('exclude_fields', {}):
-                for key in self.yaml_file['exclude_fields'][definition_name]:
-                    if key in definition_spec['required']:
-                        definition_spec['required'].remove(key)
-                    if key in definition_spec['properties']:
-                        del definition_spec['properties'][key]
+        Args:
+            names: names of the operations to compile the responses of. Defaults to all.
+        """
+        if names is None:
+            self.definition_plans = {}
+            names = list(self.response_index.keys())
+        plans = []
+        for name in names:
+            for response in self.response_index[name].values():
+                response['plan'] = self.compile_filter_plan(response['schema'], plans)
+
+        # A plan is needed if it removes keys or if one of its sub plan is needed
+        needed = set(id(plan) for plan in plans if plan.exclude or plan.fallback)
+        changed = True
+        while changed:
+            changed = False
+            for plan in plans:
+                if id(plan) not in needed and any(id(child) in needed for child in plan.children()):
+                    needed.add(id(plan))
+                    changed = True
+
+        # Prune plans
+        for plan in plans:
+            plan.properties = {k: v for k, v in plan.properties.items() if id(v) in needed}
+            if plan.items is not None and id(plan.items) not in needed:
+                plan.items = None
+            if plan.values is not None and id(plan.values) not in needed:
+                plan.values = None
+        for name in names:
+            for response in self.response_index[name].values():
+                if id(response['plan']) not in needed:
+                    response['plan'] = None
+
+    def get_filter_plan(self, name, status_code):
+        """Get the filter plan of the response of an operation.
 
-        # Write swagger.yaml
-        with open(os.path.join(os.path.dirname(os.path.realpath(self.config_file)), 'swagger.yaml'), 'w') as f:
-            f.write(yaml.dump(base_swagger, default_flow_style=False))
+        Args:
+            name: name of the operation.
+            status_code: status code of the response.
 
-    def filter_definition(self, doc):
+        Returns:
+            The FilterPlan of the response, or None if nothing has to be filtered.
+        """
+        if not self.yaml_file.get('exclude_fields'):
+            return None
+        responses = self.response_index.get(name, {})
+        response = responses.get(str(status_code), responses.get('default'))
+        if response is None:
+            return STRUCTURAL_FILTER_PLAN
+        return response.get('plan', STRUCTURAL_FILTER_PLAN)
+
+    def filter_definition(self, doc, plan=None):
         """Filter the definition in the given doc.
 
+        If a filter plan is given, only the paths of the plan are visited.
+        Otherwise the definition of each dict is found by matching it against all definitions.
+
         Args:
             doc: doc to filter.
+            plan: FilterPlan of the doc.
 
         Returns:
             A filtered doc.
         """
+        if plan is not None and not plan.fallback:
+            return self.apply_filter_plan(doc, plan)
+
         if isinstance(doc, dict):  # Filter dict
             doc_definition = self.swagger_parser.get_dict_definition(doc)
 
@@ -293,51 +2341,291 @@ class SwaggerAggregator(object):
         else:
             return doc
 
-    def generate_operation_id_function(self, spec, uri, path, action, func_name):
-        """Generate a function to handle the current path.
+    def apply_filter_plan(self, doc, plan):
+        """Filter the given doc by following its filter plan.
+
+        Args:
+            doc: doc to filter.
+            plan: FilterPlan of the doc.
+
+        Returns:
+            A filtered doc.
+        """
+        if plan.fallback:
+            return self.filter_definition(doc)
+
+        if isinstance(doc, dict):
+            # Remove keys
+            for key in plan.exclude:
+                doc.pop(key, None)
+
+            # Filter sub definition
+            for key, sub_plan in plan.properties.items():
+                if key in doc:
+                    doc[key] = self.apply_filter_plan(doc[key], sub_plan)
+            if plan.values is not None:
+                for k, v in doc.items():
+                    doc[k] = self.apply_filter_plan(v, plan.values)
+        elif isinstance(doc, list) and plan.items is not None:
+            for index, value in enumerate(doc):
+                doc[index] = self.apply_filter_plan(value, plan.items)
+        return doc
+
+    @staticmethod
+    def get_forward_headers(request_headers):
+        """Get the headers of a client request to forward to the microservice.
+
+        Args:
+            request_headers: headers of the client request.
+
+        Returns:
+            Dict of headers.
+        """
+        headers = {k: v for k, v in dict(request_headers).items()
+                   if v and k.lower() not in HOP_BY_HOP_HEADERS}
+
+        # Streamed responses are passed through with their encoding, so only ask for the ones the client accepts
+        if not any(k.lower() == 'accept-encoding' for k in headers):
+            headers['Accept-Encoding'] = 'identity'
+
+        if request_headers.get('Content-Type', '').startswith('multipart/form-data'):
+            # Remove Content-Length because it cause error on nginx side
+            if 'Content-Length' in headers:
+                headers['X-Content-Length'] = headers['Content-Length']
+                del headers['Content-Length']
+        return headers
+
+    @staticmethod
+    def stream_response(req, deadline=None):
+        """Stream the response of a microservice to the client.
+
+        The body is passed through as it is received, without being decoded.
+
+        Args:
+            req: requests.Response opened with stream=True.
+            deadline: time.time() after which the streaming is aborted.
+
+        Returns:
+            A flask.Response.
+        """
+        def generate():
+            try:
+                for chunk in iter_until(req.raw.stream(STREAM_CHUNK_SIZE, decode_content=False), deadline):
+                    yield chunk
+            finally:
+                req.close()
+
+        headers = [(k, v) for k, v in req.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS]
+        return flask.Response(flask.stream_with_context(generate()), status=req.status_code, headers=headers)
+
+    def stream_filtered_array(self, req, plan, deadline=None):
+        """Stream a JSON array response of a microservice to the client, filtering its items one by one.
+
+        Args:
+            req: requests.Response opened with stream=True.
+            plan: FilterPlan of the array.
+            deadline: time.time() after which the streaming is aborted.
+
+        Returns:
+            A flask.Response, or a (doc, status code) tuple if the response is not an array.
+        """
+        chunks = iter_until(req.iter_content(STREAM_CHUNK_SIZE), deadline)
+
+        # Check the response is an array
+        head = []
+        for chunk in chunks:
+            head.append(chunk)
+            if chunk.strip():
+                break
+        if not b''.join(head).lstrip().startswith(b'['):
+            text = b''.join(itertools.chain(head, chunks)).decode(req.encoding or 'utf-8', 'replace')
+            try:
+                return (self.filter_definition(json.loads(text), plan), req.status_code)
+            except ValueError:
+                return (text, req.status_code)
+
+        def generate():
+            try:
+                parts = [b'[']
+                size = 0
+                items = iter_json_array(itertools.chain(head, chunks), req.encoding or 'utf-8')
+                for index, item in enumerate(items):
+                    part = json.dumps(self.apply_filter_plan(item, plan.items)).encode('utf-8')
+                    if index:
+                        parts.append(b',')
+                    parts.append(part)
+                    size += len(part)
+                    if size >= STREAM_CHUNK_SIZE:
+                        yield b''.join(parts)
+                        parts = []
+                        size = 0
+                parts.append(b']')
+                yield b''.join(parts)
+            except ValueError as exc:
+                logger.error(u'Invalid JSON array from {0}: {1}'.format(req.url, repr(exc)))
+            finally:
+                req.close()
+
+        headers = [(k, v) for k, v in req.headers.items()
+                   if k.lower() not in HOP_BY_HOP_HEADERS + ('content-length', 'content-encoding')]
+        return flask.Response(flask.stream_with_context(generate()), status=req.status_code, headers=headers)
+
+    def generate_operation_id_function(self, operation):
+        """Generate a function to handle an operation.
 
         Args:
-            spec: spec of the action the generated function should handle.
-            uri: uri of the microservice corresponding to the spec.
-            func_name: name the generated function should have.
+            operation: Operation the generated function should handle.
 
         Returns:
-            A function with func_name as name.
+            A function with the operation name as name.
         """
-        @retry_http
+        metrics = self.metrics
+
         def func(*args, **kwargs):
             """Handle a flask request for the current action.
 
             """
             # Get url from spec and flask query
-            url = u'{0}{1}?{2}'.format(uri[func.__name__], path[func.__name__], flask.request.query_string)
-            p = re.compile('{(.+)}')
-            for path_param in re.findall(p, url):
-                for k, v in kwargs.items():
-                    if k == path_param:
-                        url = url.replace('{{{0}}}'.format(k), str(v))
+            if metrics is not None:
+                start = timer()
+            url = operation.url_template.expand(kwargs, flask.request.query_string)
+            if metrics is not None:
+                metrics.observe_phase(operation.name, 'url', timer() - start)
 
-            requests_meth = getattr(requests, action[func.__name__])
+            session = self.get_session(operation.api_url)
+            requests_meth = getattr(session, operation.action)
 
-            headers = {k: v for k, v in dict(flask.request.headers).items() if v}
+            headers = self.get_forward_headers(flask.request.headers)
+            deadline = get_request_deadline(flask.request.headers, operation.timeouts['deadline'])
 
             if not flask.request.headers.get('Content-Type', '').startswith('multipart/form-data'):
-                req = requests_meth(url, data=flask.request.data, headers=headers)
+                data = flask.request.data
             else:
-                # Remove Content-Length because it cause error on nginx side
-                if 'Content-Length' in headers:
-                    headers['X-Content-Length'] = headers['Content-Length']
-                    del headers['Content-Length']
+                data = flask.request.stream
+
+            # Responses are cached and coalesced by operation, url and auth scope
+            request_key = cache_key = entry = None
+            if operation.cache_ttl is not None or operation.coalesce:
+                request_key = (operation, url) + tuple(flask.request.headers.get(h) for h in AUTH_SCOPE_HEADERS)
+            if operation.cache_ttl is not None:
+                cache_key = request_key
+                entry = self.response_cache.get(cache_key)
+                if entry is not None:
+                    if entry[2] > monotonic():
+                        return entry[0]
+                    if 'If-None-Match' in headers:  # The client revalidates its own version
+                        entry = None
+                    else:
+                        headers['If-None-Match'] = entry[1]
 
-                req = requests_meth(url, data=flask.request.stream, headers=headers)
+            def fetch():
+                """Call the microservice and get the filtered result."""
+                return self.fetch_operation(operation, requests_meth, url, data, headers, deadline,
+                                            request_key is not None, cache_key, entry)
 
             try:
-                return (self.filter_definition(req.json()), req.status_code)
-            except JSONDecodeError:
-                return (req.text, req.status_code)
-        func.__name__ = func_name
+                if operation.coalesce:
+                    return self.single_flight.do(request_key, fetch, deadline)
+                return fetch()
+            except Timeout as exc:
+                logger.warning(u'{0} {1} timed out: {2}'.format(operation.action.upper(), url, exc))
+                return ({'message': 'Service {0} timed out'.format(operation.api)}, 504)
+
+        if metrics is not None:
+            handle = func
+
+            def func(*args, **kwargs):
+                """Handle a flask request for the current action, and observe its total duration.
+
+                """
+                start = timer()
+                try:
+                    return handle(*args, **kwargs)
+                finally:
+                    metrics.observe_phase(operation.name, 'total', timer() - start)
+        func.__name__ = str(operation.name)
         return func
 
+    def fetch_operation(self, operation, requests_meth, url, data, headers, deadline, buffered=False,
+                        cache_key=None, entry=None):
+        """Call the microservice of an operation and get its filtered result.
+
+        Args:
+            operation: Operation being called.
+            requests_meth: session method doing the call.
+            url: url of the call.
+            data: body of the call.
+            headers: headers of the call.
+            deadline: time.time() after which the call is aborted.
+            buffered: True if the result must not be streamed.
+            cache_key: key of the result in the response cache, None if it is not cached.
+            entry: expired entry of the response cache being revalidated.
+
+        Returns:
+            The result of the operation function.
+        """
+        metrics = self.metrics
+        breaker = self.get_circuit_breaker(operation.api)
+        if not breaker.allow_request():
+            if metrics is not None:
+                metrics.count_error(operation.name, 'circuit_open')
+            return self.get_circuit_open_error(operation.api, breaker)
+        record = breaker.release  # Calls due to fail at the client deadline are neither successes nor failures
+        try:
+            if metrics is not None:
+                start = timer()
+            req = call_with_retry(lambda: requests_meth(url, data=data, headers=headers, stream=True,
+                                                        timeout=get_call_timeout(operation.timeouts, deadline)),
+                                  operation.action, operation.retry_policy, self.retry_budget, deadline,
+                                  None if metrics is None else lambda *_: metrics.count_retry(operation.name))
+            record = breaker.record_failure if req.status_code >= 500 else breaker.record_success
+        except Exception as exc:
+            if not is_deadline_timeout(exc, deadline):
+                record = breaker.record_failure
+            if metrics is not None:
+                metrics.count_error(operation.name, 'timeout' if isinstance(exc, Timeout) else 'connection')
+            raise
+        finally:
+            record()
+        if metrics is not None:
+            metrics.observe_phase(operation.name, 'upstream', timer() - start)
+            metrics.count_status(operation.name, req.status_code)
+
+        if entry is not None and req.status_code == 304:  # Cached response still valid
+            req.close()
+            self.response_cache.set(cache_key, entry[0], get_response_ttl(req.headers, operation.cache_ttl),
+                                    entry[1])
+            return entry[0]
+
+        # Pass the response through when there is nothing to filter in it
+        plan = self.get_filter_plan(operation.name, req.status_code)
+        is_json = 'json' in req.headers.get('Content-Type', '').lower()
+        if self.yaml_file.get('stream_responses', True) and not buffered:
+            if plan is None or not is_json:
+                return self.stream_response(req, deadline)
+            if plan.items is not None:  # Array response, filter it item by item
+                return self.stream_filtered_array(req, plan, deadline)
+
+        try:
+            if metrics is not None:
+                start = timer()
+            doc = req.json()
+            if metrics is not None:
+                metrics.observe_phase(operation.name, 'parse', timer() - start)
+        except JSONDecodeError:
+            return (req.text, req.status_code)
+
+        if plan is not None:
+            if metrics is not None:
+                start = timer()
+            doc = self.filter_definition(doc, plan)
+            if metrics is not None:
+                metrics.observe_phase(operation.name, 'filter', timer() - start)
+        if cache_key is not None and req.status_code == 200:
+            self.response_cache.set(cache_key, (doc, req.status_code),
+                                    get_response_ttl(req.headers, operation.cache_ttl), req.headers.get('ETag'))
+        return (doc, req.status_code)
+
     def get_spec_from_uri(self, url, action):
         """Get spec from an path uri and an action.
 
@@ -348,7 +2636,10 @@ class SwaggerAggregator(object):
         Returns:
             (path spec, microservice url)
         """
-        for api, api_spec in self.swagger_apis.items():
-            for path_name, path_spec in api_spec['spec']['paths'].items():
-                if path_name == url:
-                    return path_spec[action], api_spec['url']
+        if self.operation_index is None:  # Apis not merged yet
+            self.operation_index = {}
+            for api, api_spec in self.swagger_apis.items():
+                self.index_operations(api, api_spec['url'], api_spec['spec'].get('paths', {}))
+
+        operation_spec, api_url, _ = self.operation_index[(url, action)]
+        return operation_spec, api_url
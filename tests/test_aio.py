@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+from mock import MagicMock
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+from aiohttp.test_utils import make_mocked_request  # noqa: E402
+
+from swagger_aggregator.aio import AsyncSingleFlight  # noqa: E402
+from swagger_aggregator.aio import AsyncSwaggerAggregator  # noqa: E402
+from swagger_aggregator.aio import copy_response  # noqa: E402
+from swagger_aggregator.swagger_aggregator import Operation  # noqa: E402
+
+
+@pytest.fixture
+def yaml_file():
+    return {
+        "args": "identifications_url",
+        "info": {
+            "version": "0.1",
+            "title": "API Gateway"
+        },
+        "basePath": "/v1",
+        "apis": {
+            "identifications": "http://identifications_url/v1"
+        },
+        'exclude_fields': {
+            'identificationsTest': ['id']
+        }
+    }
+
+
+def test_generate_operation_id_function(mocker, yaml_file):
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+
+    async def upstream(request):
+        assert request.query_string == 'query=test'
+        assert await request.read() == b'{"trax": "air"}'
+        return web.json_response({'id': request.match_info['id'], 'test': 'success'}, status=201)
+
+    async def run():
+        app = web.Application()
+        app.router.add_post('/v1/identifications/{id}', upstream)
+        server = TestServer(app)
+        await server.start_server()
+
+        agg = AsyncSwaggerAggregator('config.yaml', 'trax')
+        agg.swagger_parser = MagicMock()
+        agg.swagger_parser.get_dict_definition.return_value = 'identificationsTest'
+        try:
+            func = agg.generate_operation_id_function(Operation('post_identifications_id', '/identifications/{id}', 'post',
+                                                                'identifications', str(server.make_url('/v1')), {}))
+            request = make_mocked_request('POST', '/v1/identifications/123?query=test',
+                                          headers={'Content-Type': 'application/json'})
+            request.read = MagicMock(return_value=asyncio.sleep(0, result=b'{"trax": "air"}'))
+            return await func(request, id='123')
+        finally:
+            await agg.close()
+            await server.close()
+
+    response = asyncio.run(run())
+
+    assert response.status == 201
+    assert json.loads(response.text) == {'test': 'success'}
+
+
+def test_async_single_flight():
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return web.json_response({'test': 'success'})
+
+    async def run():
+        single_flight = AsyncSingleFlight()
+        return await asyncio.gather(*[single_flight.do('key', call, share=lambda r: 'copy') for _ in range(3)])
+
+    results = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert results[0].status == 200
+    assert results[1:] == ['copy', 'copy']
+
+
+def test_async_single_flight_cancel():
+    async def call():
+        await asyncio.sleep(0.01)
+        return 'result'
+
+    async def run():
+        single_flight = AsyncSingleFlight()
+        leader = asyncio.ensure_future(single_flight.do('key', call))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(single_flight.do('key', call, share=lambda r: 'copy'))
+        await asyncio.sleep(0)
+        leader.cancel()
+        result = await follower
+        return leader.cancelled(), result, single_flight.flights
+
+    # Cancelling the caller running the call does not cancel it for the others
+    assert asyncio.run(run()) == (True, 'copy', {})
+
+
+def test_copy_response():
+    response = web.json_response({'message': 'Service down'}, status=503, headers={'Retry-After': '30'})
+    copy = copy_response(response)
+
+    assert copy is not response
+    assert copy.status == 503
+    assert copy.headers['Retry-After'] == '30'
+    assert copy.content_type == 'application/json'
+    assert json.loads(copy.text) == {'message': 'Service down'}
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from swagger_aggregator.metrics import Histogram
+from swagger_aggregator.metrics import InMemoryMetrics
+
+
+def test_histogram():
+    histogram = Histogram((0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.1)
+    histogram.observe(0.5)
+    histogram.observe(2)
+
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.count == 4
+    assert histogram.sum == 2.65
+
+
+def test_in_memory_metrics_render():
+    metrics = InMemoryMetrics(buckets=(1, 0.1))
+    metrics.observe_phase('get_test', 'upstream', 0.5)
+    metrics.count_retry('get_test')
+    metrics.count_status('get_test', 200)
+    metrics.count_status('get_test', 200)
+    metrics.count_error('get_test', 'timeout')
+
+    assert metrics.render().splitlines() == [
+        '# TYPE swagger_aggregator_phase_seconds histogram',
+        'swagger_aggregator_phase_seconds_bucket{operation="get_test",phase="upstream",le="0.1"} 0',
+        'swagger_aggregator_phase_seconds_bucket{operation="get_test",phase="upstream",le="1"} 1',
+        'swagger_aggregator_phase_seconds_bucket{operation="get_test",phase="upstream",le="+Inf"} 1',
+        'swagger_aggregator_phase_seconds_sum{operation="get_test",phase="upstream"} 0.5',
+        'swagger_aggregator_phase_seconds_count{operation="get_test",phase="upstream"} 1',
+        '# TYPE swagger_aggregator_retries_total counter',
+        'swagger_aggregator_retries_total{operation="get_test"} 1',
+        '# TYPE swagger_aggregator_upstream_responses_total counter',
+        'swagger_aggregator_upstream_responses_total{operation="get_test",status="200"} 2',
+        '# TYPE swagger_aggregator_upstream_errors_total counter',
+        'swagger_aggregator_upstream_errors_total{operation="get_test",kind="timeout"} 1',
+    ]
@@ -1,10 +1,48 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import gzip
+import io
+import flask
+import json
+import os
 from mock import MagicMock
 import pytest
+import stat
+import threading
+import time
+import yaml
+from requests.exceptions import ConnectionError
+from requests.exceptions import RequestException
+from requests.exceptions import Timeout
+from six.moves import BaseHTTPServer
 
 from swagger_aggregator import SwaggerAggregator
+from swagger_aggregator import operations
+from swagger_aggregator.metrics import CallbackSink
+from swagger_aggregator.swagger_aggregator import CircuitBreaker
+from swagger_aggregator.swagger_aggregator import Operation
+from swagger_aggregator.swagger_aggregator import ResponseCache
+from swagger_aggregator.swagger_aggregator import RouteIndex
+from swagger_aggregator.swagger_aggregator import SerializedSwagger
+from swagger_aggregator.swagger_aggregator import SingleFlight
+from swagger_aggregator.swagger_aggregator import RetryPolicy
+from swagger_aggregator.swagger_aggregator import TokenBucket
+from swagger_aggregator.swagger_aggregator import UrlTemplate
+from swagger_aggregator.swagger_aggregator import YamlDumper
+from swagger_aggregator.swagger_aggregator import get_call_timeout
+from swagger_aggregator.swagger_aggregator import get_request_deadline
+from swagger_aggregator.swagger_aggregator import get_response_ttl
+from swagger_aggregator.swagger_aggregator import gzip_bytes
+from swagger_aggregator.swagger_aggregator import iter_json_array
+from swagger_aggregator.swagger_aggregator import namespace_refs
+from swagger_aggregator.swagger_aggregator import write_file_atomic
+
+
+@pytest.fixture(autouse=True)
+def clear_operations():
+    yield
+    operations.functions.clear()
 
 
 @pytest.fixture
@@ -67,12 +105,69 @@ def test_get_aggregate_swagger(yaml_file, mocker):
     mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
     mock_request = mocker.patch('swagger_aggregator.swagger_aggregator.requests')
     mock_request.get.return_value.json.return_value = 'swagger'
+    mock_request.get.return_value.content = b'swagger'
     agg = SwaggerAggregator('config.yaml', 'trax', 'air')
 
     assert agg.get_aggregate_swagger() == {'identifications': {'spec': 'swagger', 'url': 'http://trax/v1'},
                                            'ingestion': {'spec': 'swagger', 'url': 'http://air/v1'}}
 
 
+def test_get_aggregate_swagger_errors(yaml_file, mocker):
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+
+    def get_swagger_from_url(api_url):
+        if api_url == 'http://ingestion_url/v1':
+            raise RequestException('down')
+        return api_url
+
+    for fetch_workers in [1, 4]:
+        agg = SwaggerAggregator('config.yaml', 'trax', 'air', fetch_workers=fetch_workers)
+        agg.get_swagger_from_url = get_swagger_from_url
+
+        assert agg.get_aggregate_swagger() == {'identifications': {'spec': 'http://identifications_url/v1',
+                                                                   'url': 'http://trax/v1'}}
+        assert agg.errors == ['http://ingestion_url/v1']
+
+
+def test_refresh_apis(yaml_file, mocker):
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    mock_request = mocker.patch('swagger_aggregator.swagger_aggregator.requests')
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air', fetch_workers=1)
+    agg.update_api = MagicMock()
+
+    def response(status_code, content, etag):
+        req = MagicMock()
+        req.status_code = status_code
+        req.content = content
+        req.headers = {'ETag': etag}
+        req.json.side_effect = lambda: json.loads(content.decode('utf-8'))
+        return req
+
+    mock_request.get.side_effect = [response(200, b'{"v": 1}', '"1"'), response(200, b'{"v": 1}', '"1"')]
+    agg.get_aggregate_swagger()
+    assert agg.swagger_apis['identifications']['spec'] == {'v': 1}
+
+    # Not modified
+    mock_request.get.side_effect = [response(304, b'', None), response(200, b'{"v": 1}', '"1bis"')]
+    assert agg.refresh_apis() == []
+    assert mock_request.get.call_args_list[-2][1]['headers'] == {'If-None-Match': '"1"'}
+
+    # Generated aggregate
+    agg.swagger = {}
+    mock_request.get.side_effect = [response(200, b'{"v": 2}', '"2"'), response(304, b'', None)]
+    assert agg.refresh_apis() == ['identifications']
+    agg.update_api.assert_called_once_with('identifications', {'v': 2}, 'http://trax/v1')
+    assert mock_request.get.call_args_list[-1][1]['headers'] == {'If-None-Match': '"1bis"'}
+
+
 def test_exclude_paths(mocker, yaml_file):
     swagger = {
         'paths': {
@@ -105,6 +200,40 @@ def test_exclude_paths(mocker, yaml_file):
             }
         }
     }
+    assert swagger['paths']['/identifications/{id}/history/'] == {'get': {}, 'post': {}}
+
+
+def test_route_index():
+    index = RouteIndex(['GET /pets/{petId}', 'DELETE /pets/{petId}', 'GET,PUT /admin/*', '* /internal/*/debug'])
+
+    assert index.get_methods('/pets/{petId}') == frozenset(['get', 'delete'])
+    assert index.match('/admin/users', 'put')
+    assert not index.match('/admin/users', 'post')
+    assert index.match('/internal/pets/debug', 'patch')
+    assert not index.match('/internal/pets', 'get')
+    assert index.get_methods('/pets') == frozenset()
+
+    with pytest.raises(ValueError):
+        RouteIndex(['/pets'])
+
+
+def test_merge_aggregates_exclude_paths(mocker, yaml_file):
+    yaml_file['exclude_paths'].append('POST /identifications/*')
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air')
+
+    swagger_apis = {'identifications': {'spec': {'paths': {'/identifications/': {'get': {}, 'post': {}},
+                                                           '/identifications/{id}': {'get': {}, 'post': {}}}},
+                                        'url': 'http://trax/v1'}}
+    swagger = {'definitions': {}, 'paths': {}}
+    agg.merge_aggregates(swagger, swagger_apis)
+
+    assert swagger['paths'] == {'/identifications/{id}': {'get': {}}}
+    assert list(agg.operation_index.keys()) == [('/identifications/{id}', 'get')]
 
 
 def test_get_spec_from_uri(mocker, yaml_file):
@@ -146,6 +275,53 @@ def test_get_spec_from_uri(mocker, yaml_file):
     assert agg.get_spec_from_uri('test2', 'post') == ({'post': {}}, 'http://air/v1')
 
 
+def test_namespace_refs():
+    unchanged = {'type': 'string', 'description': 'See #/definitions/Test'}
+    spec = {
+        'paths': {'/test': {'get': {'responses': {'200': {'schema': {'$ref': '#/definitions/Test'}}}}}},
+        'definitions': {'Test': {'properties': {'sub': {'type': 'array', 'items': {'$ref': '#/definitions/Sub'}},
+                                                'name': unchanged}}}
+    }
+
+    renamed = namespace_refs(spec, 'identifications')
+
+    assert renamed['paths']['/test']['get']['responses']['200']['schema'] == {'$ref': '#/definitions/identificationsTest'}
+    assert renamed['definitions']['Test']['properties']['sub']['items'] == {'$ref': '#/definitions/identificationsSub'}
+    assert renamed['definitions']['Test']['properties']['name'] is unchanged
+    assert spec['paths']['/test']['get']['responses']['200']['schema'] == {'$ref': '#/definitions/Test'}
+    assert namespace_refs(unchanged, 'identifications') is unchanged
+
+
+def test_merge_aggregates(mocker, yaml_file):
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air')
+
+    def swagger_aggregate():
+        return {'identifications': {'spec': {'paths': {'/test': {'get': {'schema': {'$ref': '#/definitions/Test'}},
+                                                                 'post': {}}},
+                                             'definitions': {'Test': {}}},
+                                    'url': 'http://trax/v1'},
+                'ingestion': {'spec': {'paths': {'/test': {'post': {'ingestion': True}, 'parameters': []}}},
+                              'url': 'http://air/v1'}}
+    agg.get_aggregate_swagger = swagger_aggregate
+
+    swagger = {'definitions': {}, 'paths': {}}
+    agg.merge_aggregates(swagger)
+
+    assert swagger['paths'] == {'/test': {'get': {'schema': {'$ref': '#/definitions/identificationsTest'}},
+                                          'post': {'ingestion': True},
+                                          'parameters': []}}
+    assert agg.get_spec_from_uri('/test', 'get') == ({'schema': {'$ref': '#/definitions/identificationsTest'}},
+                                                     'http://trax/v1')
+    assert agg.operation_index[('/test', 'post')] == ({'ingestion': True}, 'http://air/v1', 'ingestion')
+    assert ('/test', 'parameters') not in agg.operation_index
+    assert agg.path_collisions == [{'path': '/test', 'action': 'post', 'api': 'ingestion', 'replaced_api': 'identifications'}]
+
+
 def test_generate_operation_id_function(mocker, yaml_file):
     try:
         mocker.patch('__builtin__.open', create=True)
@@ -155,6 +331,7 @@ def test_generate_operation_id_function(mocker, yaml_file):
     agg = SwaggerAggregator('config.yaml', 'trax', 'air')
 
     mock_request = mocker.patch('swagger_aggregator.swagger_aggregator.requests')
+    mock_request.Session.return_value.post.return_value.status_code = 201
     flask_mock = mocker.patch('swagger_aggregator.swagger_aggregator.flask')
     flask_mock.request.data = '{"trax": "air"}'
     flask_mock.request.query_string = 'query=test&test=success'
@@ -177,9 +354,525 @@ def test_generate_operation_id_function(mocker, yaml_file):
         }
     }
 
-    agg.generate_operation_id_function(spec, {'func_name': 'url'}, {'func_name': '/path/'}, {'func_name': 'post'}, 'func_name')()
+    agg.generate_operation_id_function(Operation('func_name', '/path/', 'post', 'identifications', 'url', spec))()
+
+    assert len(mock_request.Session.return_value.post.call_args_list) == 1
+    assert mock_request.Session.return_value.post.call_args[0][0] == 'url/path/?query=test&test=success'
+    assert len(mock_request.post.call_args_list) == 0
+
+
+def test_retry_policy(mocker):
+    mocker.patch('swagger_aggregator.swagger_aggregator.get_retry_sleep', return_value=1)
+    mocker.patch('swagger_aggregator.swagger_aggregator.time.time', return_value=100)
+    policy = RetryPolicy(max_retries=3, max_sleep_time=5)
+
+    assert policy.get_sleep('get', 0, 0) == 1
+    assert policy.get_sleep('post', 0, 0) is None
+    assert policy.get_sleep('get', 3, 0) is None
+    assert policy.get_sleep('get', 1, 4.5) is None
+    assert policy.get_sleep('get', 0, 0, deadline=101) is None
+    assert policy.get_sleep('get', 0, 0, deadline=102) == 1
+
+    budget = TokenBucket(0, 1)
+    assert policy.get_sleep('get', 0, 0, budget=budget) == 1
+    assert policy.get_sleep('get', 0, 0, budget=budget) is None
+
+
+def test_generate_operation_id_function_retry(mocker, yaml_file):
+    yaml_file['retry'] = {'max_retries': 2}
+    yaml_file['apis']['ingestion'] = {'url': 'http://ingestion_url/v1', 'retry': {'methods': ['get', 'post']}}
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air')
+
+    mock_request = mocker.patch('swagger_aggregator.swagger_aggregator.requests')
+    mock_request.Session.return_value.post.side_effect = ConnectionError('down')
+    flask_mock = mocker.patch('swagger_aggregator.swagger_aggregator.flask')
+    flask_mock.request.query_string = ''
+    flask_mock.request.headers = {}
+    sleep = mocker.patch('swagger_aggregator.swagger_aggregator.time.sleep')
+
+    # POST is not retried by default
+    operation = Operation('func_name', '/path/', 'post', 'identifications', 'url', {})
+    operation.retry_policy = agg.get_retry_policy('identifications')
+    with pytest.raises(ConnectionError):
+        agg.generate_operation_id_function(operation)()
+    assert len(mock_request.Session.return_value.post.call_args_list) == 1
+    assert not sleep.called
+
+    # Unless the api retries it
+    operation.retry_policy = agg.get_retry_policy('ingestion')
+    with pytest.raises(ConnectionError):
+        agg.generate_operation_id_function(operation)()
+    assert len(mock_request.Session.return_value.post.call_args_list) == 4
+    assert len(sleep.call_args_list) == 2
+
+
+def test_circuit_breaker(mocker):
+    now = mocker.patch('swagger_aggregator.swagger_aggregator.monotonic', return_value=0)
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=10, half_open_max_calls=1)
+
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    assert breaker.get_status() == {'state': 'open', 'failures': 2, 'retry_after': 10}
+
+    # A single probe goes through after the recovery timeout
+    now.return_value = 10
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # A probe without outcome gives its slot back
+    now.return_value = 20
+    assert breaker.allow_request()
+    breaker.release()
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+
+
+def test_generate_operation_id_function_circuit_open(mocker, yaml_file):
+    yaml_file['circuit_breaker'] = {'failure_threshold': 2}
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air')
+
+    mock_request = mocker.patch('swagger_aggregator.swagger_aggregator.requests')
+    mock_request.Session.return_value.post.return_value.status_code = 503
+    flask_mock = mocker.patch('swagger_aggregator.swagger_aggregator.flask')
+    flask_mock.request.query_string = ''
+    flask_mock.request.headers = {}
+    mocker.patch('swagger_aggregator.swagger_aggregator.SwaggerAggregator.stream_response')
+
+    func = agg.generate_operation_id_function(Operation('func_name', '/path/', 'post', 'identifications', 'url', {}))
+    func()
+    func()
+    result = func()
+
+    assert len(mock_request.Session.return_value.post.call_args_list) == 2
+    assert result[1] == 503
+    assert agg.get_circuit_states()['identifications']['state'] == 'open'
+
+
+def test_generate_operation_id_function_circuit_half_open_deadline(mocker, yaml_file):
+    yaml_file['circuit_breaker'] = {'failure_threshold': 1, 'recovery_timeout': 10}
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    now = mocker.patch('swagger_aggregator.swagger_aggregator.monotonic', return_value=0)
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air')
+
+    mock_request = mocker.patch('swagger_aggregator.swagger_aggregator.requests')
+    mock_request.Session.return_value.get.return_value.status_code = 503
+    flask_mock = mocker.patch('swagger_aggregator.swagger_aggregator.flask')
+    flask_mock.request.query_string = ''
+    flask_mock.request.headers = {}
+    mocker.patch('swagger_aggregator.swagger_aggregator.SwaggerAggregator.stream_response')
+
+    func = agg.generate_operation_id_function(Operation('func_name', '/path/', 'get', 'identifications', 'url', {}))
+    func()
+    assert agg.get_circuit_states()['identifications']['state'] == 'open'
+
+    # The probe hits the client deadline, the next request probes again
+    now.return_value = 10
+    flask_mock.request.headers = {'X-Request-Timeout': '0'}
+    assert func()[1] == 504
+    assert agg.get_circuit_states()['identifications']['state'] == 'half_open'
+
+    mock_request.Session.return_value.get.return_value.status_code = 200
+    flask_mock.request.headers = {}
+    func()
+    assert len(mock_request.Session.return_value.get.call_args_list) == 2
+    assert agg.get_circuit_states()['identifications']['state'] == 'closed'
+
+
+def test_get_timeouts(mocker, yaml_file):
+    yaml_file['timeouts'] = {'connect': 1, 'read': 5}
+    yaml_file['apis']['ingestion'] = {'url': 'http://ingestion_url/v1', 'timeouts': {'read': 10}}
+    yaml_file['operations'] = {'GET /ingestions/{id}': {'timeouts': {'deadline': 20}}}
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air')
+
+    assert agg.get_timeouts('identifications', '/identifications', 'get') == {'connect': 1, 'read': 5,
+                                                                              'deadline': None}
+    assert agg.get_timeouts('ingestion', '/ingestions/{id}', 'get') == {'connect': 1, 'read': 10, 'deadline': 20}
+    assert agg.get_timeouts('ingestion', '/ingestions/{id}', 'put') == {'connect': 1, 'read': 10, 'deadline': None}
+
+
+def test_get_call_timeout(mocker):
+    mocker.patch('swagger_aggregator.swagger_aggregator.time.time', return_value=100)
+
+    assert get_request_deadline({}) is None
+    assert get_request_deadline({}, 5) == 105
+    assert get_request_deadline({'X-Request-Timeout': '2'}, 5) == 102
+    assert get_request_deadline({'X-Request-Timeout': '10'}, 5) == 105
+
+    assert get_call_timeout({'connect': 1, 'read': 5}) == (1, 5)
+    assert get_call_timeout({'connect': 1, 'read': 5}, 103) == (1, 3)
+    assert get_call_timeout({'connect': None, 'read': None}, 103) == (3, 3)
+    with pytest.raises(Timeout):
+        get_call_timeout({'connect': 1, 'read': 5}, 100)
+
+
+def test_generate_operation_id_function_timeout(mocker, yaml_file):
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air')
+
+    mock_request = mocker.patch('swagger_aggregator.swagger_aggregator.requests')
+    mock_request.Session.return_value.get.side_effect = Timeout('read timeout')
+    flask_mock = mocker.patch('swagger_aggregator.swagger_aggregator.flask')
+    flask_mock.request.query_string = ''
+    flask_mock.request.headers = {}
+
+    operation = Operation('func_name', '/path/', 'get', 'identifications', 'url', {})
+    operation.timeouts = {'connect': 1, 'read': 2, 'deadline': None}
+    result = agg.generate_operation_id_function(operation)()
+
+    assert mock_request.Session.return_value.get.call_args[1]['timeout'] == (1, 2)
+    assert result[1] == 504
+    assert agg.get_circuit_breaker('identifications').failures == 1
+
+    # Expired client deadlines do not open the circuit of the api
+    flask_mock.request.headers = {'X-Request-Timeout': '0'}
+    func = agg.generate_operation_id_function(operation)
+    for _ in range(10):
+        assert func()[1] == 504
+    assert mock_request.Session.return_value.get.call_count == 1
+    assert agg.get_circuit_states()['identifications'] == {'state': 'closed', 'failures': 1, 'retry_after': 0}
+
+    # Neither do timeouts at a client deadline shorter than the timeouts of the api
+    def get(*args, **kwargs):
+        time.sleep(kwargs['timeout'][1])
+        raise Timeout('read timeout')
+    mock_request.Session.return_value.get.side_effect = get
+    flask_mock.request.headers = {'X-Request-Timeout': '0.01'}
+    assert func()[1] == 504
+    assert mock_request.Session.return_value.get.call_args[1]['timeout'][1] <= 0.01
+    assert agg.get_circuit_breaker('identifications').failures == 1
+
+
+def test_response_cache(mocker):
+    now = mocker.patch('swagger_aggregator.swagger_aggregator.monotonic', return_value=0)
+    cache = ResponseCache(max_entries=2)
+
+    cache.set('a', 'result_a', 10)
+    cache.set('b', 'result_b', 10, etag='"b"')
+    assert cache.get('a') == ('result_a', None, 10)
+    cache.set('c', 'result_c', 10)
+    assert cache.get('b') is None  # Least recently used
+    assert cache.get('a') is not None
+
+    # Expired entries are only kept for revalidation
+    cache.set('b', 'result_b', 10, etag='"b"')
+    now.return_value = 20
+    assert cache.get('a') is None
+    assert cache.get('b') == ('result_b', '"b"', 10)
+    cache.set('b', 'result_b', None)
+    assert cache.get('b') is None
+
+    assert get_response_ttl({}, 60) == 60
+    assert get_response_ttl({'Cache-Control': 'public, max-age=30'}, 60) == 30
+    assert get_response_ttl({'Cache-Control': 'no-store'}, 60) is None
+    assert get_response_ttl({'Cache-Control': 'private, max-age=30'}, 60) is None
+
+
+def test_generate_operation_id_function_cache(mocker, yaml_file):
+    yaml_file['operations'] = {'GET /path/': {'cache': {'ttl': 10}}}
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air')
+    now = mocker.patch('swagger_aggregator.swagger_aggregator.monotonic', return_value=0)
+
+    mock_request = mocker.patch('swagger_aggregator.swagger_aggregator.requests')
+    get = mock_request.Session.return_value.get
+    get.return_value.status_code = 200
+    get.return_value.headers = {'Content-Type': 'application/json', 'ETag': '"v1"'}
+    get.return_value.json.return_value = {'id': 1, 'test': 'success'}
+    flask_mock = mocker.patch('swagger_aggregator.swagger_aggregator.flask')
+    flask_mock.request.query_string = ''
+    flask_mock.request.headers = {'Authorization': 'token'}
+    filter_definition = mocker.patch.object(agg, 'filter_definition', return_value={'test': 'success'})
+    mocker.patch.object(agg, 'get_filter_plan', return_value=object())
+
+    operation = Operation('get_path', '/path/', 'get', 'identifications', 'url', {})
+    operation.cache_ttl = agg.get_cache_ttl('/path/', 'get')
+    func = agg.generate_operation_id_function(operation)
+
+    assert func() == ({'test': 'success'}, 200)
+    assert func() == ({'test': 'success'}, 200)
+    assert len(get.call_args_list) == 1
+    assert len(filter_definition.call_args_list) == 1
+
+    # Another auth scope is not served from the cache
+    flask_mock.request.headers = {'Authorization': 'other'}
+    func()
+    assert len(get.call_args_list) == 2
+
+    # Expired responses are revalidated with their ETag
+    now.return_value = 20
+    get.return_value.status_code = 304
+    assert func() == ({'test': 'success'}, 200)
+    assert get.call_args[1]['headers']['If-None-Match'] == '"v1"'
+    assert len(filter_definition.call_args_list) == 2
+
+
+def test_single_flight():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def call():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return ({'test': 'success'}, 200)
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(single_flight.do('key', call)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(single_flight.do('key', call))) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert results == [({'test': 'success'}, 200)] * 4
+    assert single_flight.flights == {}
+
+    # Once the call is done, a new call is made
+    single_flight.do('key', call)
+    assert len(calls) == 2
+
+
+def test_single_flight_deadline(mocker):
+    single_flight = SingleFlight()
+    single_flight.flights['key'] = SingleFlight.Flight()
+
+    with pytest.raises(Timeout):
+        single_flight.do('key', MagicMock(), deadline=0)
+
+
+def test_get_coalesce(mocker, yaml_file):
+    yaml_file['operations'] = {'GET /path/': {'coalesce': True}, 'GET /other/': {'coalesce': False}}
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air')
+
+    assert agg.get_coalesce('/path/', 'get')
+    assert not agg.get_coalesce('/path/', 'post')
+    assert not agg.get_coalesce('/test/', 'get')
+
+    yaml_file['coalesce_requests'] = True
+    assert agg.get_coalesce('/test/', 'get')
+    assert not agg.get_coalesce('/other/', 'get')
+
+
+def test_get_session(mocker, yaml_file):
+    yaml_file['connection_pool'] = {'pool_maxsize': 20}
+    yaml_file['apis']['ingestion'] = {'url': 'http://ingestion_url/v1', 'pool_maxsize': 50, 'keep_alive': False}
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air')
 
-    assert len(mock_request.post.call_args_list) == 1
+    identifications_session = agg.get_session('http://trax/v1')
+    ingestion_session = agg.get_session('http://air/v1')
+
+    assert agg.get_session('http://trax/v1') is identifications_session
+    assert identifications_session.get_adapter('http://trax/v1')._pool_maxsize == 20
+    assert 'Connection' not in identifications_session.headers or \
+        identifications_session.headers['Connection'] != 'close'
+    assert ingestion_session.get_adapter('http://air/v1')._pool_maxsize == 50
+    assert ingestion_session.headers['Connection'] == 'close'
+
+
+def test_url_template():
+    template = UrlTemplate('http://trax/v1', '/identifications/{id}/sources/{source_id}')
+
+    assert template.expand({'id': 12, 'source_id': 'a/b c'}) == 'http://trax/v1/identifications/12/sources/a%2Fb%20c'
+    assert template.expand({'id': 12}, b'q=a b&r=%C3%A9') == 'http://trax/v1/identifications/12/sources/{source_id}?q=a%20b&r=%C3%A9'
+    assert template.expand({'id': 12, 'source_id': 1}, u'q=\xe9') == 'http://trax/v1/identifications/12/sources/1?q=%C3%A9'
+
+
+def test_generate_operation_id_function_stream(mocker, yaml_file):
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air')
+
+    mock_request = mocker.patch('swagger_aggregator.swagger_aggregator.requests')
+    flask_mock = mocker.patch('swagger_aggregator.swagger_aggregator.flask')
+    flask_mock.request.headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+    flask_mock.request.query_string = ''
+    flask_mock.stream_with_context.side_effect = lambda generator: generator
+    req = mock_request.Session.return_value.get.return_value
+    req.status_code = 200
+    req.headers = {'Content-Type': 'image/png', 'Content-Length': '6', 'Transfer-Encoding': 'chunked'}
+    req.raw.stream.return_value = [b'abc', b'def']
+
+    func = agg.generate_operation_id_function(Operation('func_name', '/path/', 'get', 'identifications', 'url', {}))
+    func()
+
+    assert mock_request.Session.return_value.get.call_args[1]['stream']
+    assert 'Connection' not in mock_request.Session.return_value.get.call_args[1]['headers']
+    args, kwargs = flask_mock.Response.call_args
+    assert kwargs['status'] == 200
+    assert sorted(kwargs['headers']) == [('Content-Length', '6'), ('Content-Type', 'image/png')]
+    assert list(args[0]) == [b'abc', b'def']
+    assert req.close.called
+    assert not req.json.called
+
+
+def test_generate_operation_id_function_stream_gzip(mocker, yaml_file):
+    yaml_file['exclude_fields'] = {}
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+
+    body = b'{"test": "success"}'
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            data = body
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                data = gzip_bytes(body)
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        agg = SwaggerAggregator('config.yaml', 'trax', 'air')
+        func = agg.generate_operation_id_function(Operation(
+            'func_name', '/path/', 'get', 'identifications', 'http://{0}:{1}'.format(*server.server_address), {}))
+        app = flask.Flask(__name__)
+        app.add_url_rule('/path/', 'func_name', func)
+        client = app.test_client()
+
+        # The client does not accept gzip
+        response = client.get('/path/')
+        assert response.status_code == 200
+        assert 'Content-Encoding' not in response.headers
+        assert response.data == body
+
+        # The client accepts gzip, the compressed body is passed through
+        response = client.get('/path/', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert gzip.GzipFile(fileobj=io.BytesIO(response.data)).read() == body
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_generate_operation_id_function_stream_filter(mocker, yaml_file):
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air')
+    agg.definitions = {
+        'identificationsTest': {
+            'type': 'object',
+            'properties': {
+                'id': {'type': 'string'},
+                'test': {'type': 'string'}
+            }
+        }
+    }
+    agg.response_index = {'func_name': agg.get_response_index({
+        'responses': {200: {'schema': {'type': 'array', 'items': {'$ref': '#/definitions/identificationsTest'}}}}
+    })}
+    agg.compile_filter_plans()
+
+    mock_request = mocker.patch('swagger_aggregator.swagger_aggregator.requests')
+    flask_mock = mocker.patch('swagger_aggregator.swagger_aggregator.flask')
+    flask_mock.request.headers = {}
+    flask_mock.request.query_string = ''
+    flask_mock.stream_with_context.side_effect = lambda generator: generator
+    req = mock_request.Session.return_value.get.return_value
+    req.status_code = 200
+    req.encoding = None
+    req.headers = {'Content-Type': 'application/json', 'Content-Length': '55', 'Content-Encoding': 'gzip'}
+    body = b' [{"id": "1", "test": "a"}, {"id": "2", "test": "b"}]'
+    req.iter_content.return_value = [body[i:i + 4] for i in range(0, len(body), 4)]
+
+    func = agg.generate_operation_id_function(Operation('func_name', '/path/', 'get', 'identifications', 'url', {}))
+    func()
+
+    args, kwargs = flask_mock.Response.call_args
+    assert kwargs['headers'] == [('Content-Type', 'application/json')]
+    assert json.loads(b''.join(args[0]).decode('utf-8')) == [{'test': 'a'}, {'test': 'b'}]
+    assert req.close.called
+
+    # Not an array
+    req.iter_content.return_value = [b'{"id": "1", ', b'"test": "a"}']
+    assert func() == ({'id': '1', 'test': 'a'}, 200)
+
+    # Not JSON, the body was already consumed
+    type(req).text = mocker.PropertyMock(side_effect=RuntimeError('The content was already consumed'))
+    req.iter_content.return_value = [b'<html>', b'Error</html>']
+    assert func() == ('<html>Error</html>', 200)
+    req.iter_content.return_value = []
+    assert func() == ('', 200)
+
+
+def test_iter_json_array():
+    body = b'[1, 12.5e3, "a,]", {"b": [true, null]}, []]'
+    for size in range(1, len(body)):
+        chunks = [body[i:i + size] for i in range(0, len(body), size)]
+        assert list(iter_json_array(chunks)) == [1, 12.5e3, 'a,]', {'b': [True, None]}, []]
+
+    for body in [b'{}', b'[1, 2', b'[1 2]', b'[1,]']:
+        with pytest.raises(ValueError):
+            list(iter_json_array([body]))
 
 
 def test_filter_definition(mocker, yaml_file):
@@ -210,6 +903,91 @@ def test_filter_definition(mocker, yaml_file):
     ]
 
 
+def test_filter_definition_plan(mocker, yaml_file):
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air')
+
+    agg.swagger_parser = MagicMock()
+    agg.swagger_parser.get_dict_definition.return_value = 'identificationsSubTest'
+    agg.definitions = {
+        'identificationsTest': {
+            'type': 'object',
+            'properties': {
+                'id': {'type': 'string'},
+                'test': {'type': 'string'},
+                'sub': {'$ref': '#/definitions/identificationsSubTest'},
+                'any': {'type': 'object'}
+            }
+        },
+        'identificationsSubTest': {
+            'type': 'object',
+            'properties': {
+                'id': {'type': 'string'},
+                'test': {'type': 'string'}
+            }
+        },
+        'identificationsOther': {
+            'type': 'object',
+            'properties': {
+                'id': {'type': 'string'},
+                'parent': {'$ref': '#/definitions/identificationsOther'}
+            }
+        }
+    }
+    agg.response_index = {
+        'func_name': agg.get_response_index({
+            'responses': {
+                200: {'schema': {'type': 'array', 'items': {'$ref': '#/definitions/identificationsTest'}}},
+                'default': {'description': 'error'}
+            }
+        }),
+        'other': agg.get_response_index({
+            'responses': {
+                200: {'schema': {'$ref': '#/definitions/identificationsOther'}}
+            }
+        })
+    }
+    agg.compile_filter_plans()
+
+    # Nothing to filter
+    assert agg.get_filter_plan('other', 200) is None
+
+    plan = agg.get_filter_plan('func_name', 200)
+    assert plan.items.exclude == ('id',)
+    assert sorted(plan.items.properties.keys()) == ['any', 'sub']
+    assert plan.items.properties['sub'].exclude == ('id',)
+
+    doc = [
+        {'id': '123',
+            'test': '456',
+            'sub': {
+                'id': '789',
+                'test': '147'
+            }}
+    ]
+
+    assert agg.filter_definition(doc, plan) == [
+        {'test': '456',
+            'sub': {
+                'test': '147'
+            }}
+    ]
+    assert not agg.swagger_parser.get_dict_definition.called
+
+    # Ambiguous schema, fall back on definition matching
+    doc = [{'any': {'id': '789', 'test': '147'}}]
+    assert agg.filter_definition(doc, plan) == [{'any': {'test': '147'}}]
+    assert agg.swagger_parser.get_dict_definition.called
+
+    # Unknown schema
+    assert agg.get_filter_plan('func_name', 404).fallback
+    assert agg.get_filter_plan('unknown', 200).fallback
+
+
 def test_generate_swagger_json(mocker, yaml_file):
     try:
         mocker.patch('__builtin__.open', create=True)
@@ -217,10 +995,10 @@ def test_generate_swagger_json(mocker, yaml_file):
         mocker.patch('builtins.open', create=True)
     mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
     mock_yaml = mocker.patch('swagger_aggregator.swagger_aggregator.yaml.dump')
+    mocker.patch('swagger_aggregator.swagger_aggregator.write_file_atomic')
     mocker.patch('swagger_aggregator.swagger_aggregator.SwaggerParser')
     mocker.patch('swagger_aggregator.swagger_aggregator.SwaggerAggregator.generate_operation_id_function')
     mocker.patch('swagger_aggregator.swagger_aggregator.SwaggerAggregator.get_spec_from_uri', return_value=('uri', {}))
-    mocker.patch('swagger_aggregator.swagger_aggregator.uuid', return_value='string')
     agg = SwaggerAggregator('config.yaml', 'trax', 'air')
 
     def exclude_paths(swagger):
@@ -237,6 +1015,270 @@ def test_generate_swagger_json(mocker, yaml_file):
     mock_yaml.assert_called_once_with({'info': {'version': '0.1', 'title': 'API Gateway'},
                                        'definitions': {'ingestion147': {'put': {}}, 'identifications456': {'post': {}}},
                                        'basePath': '/v1', 'swagger': '2.0',
-                                       'paths': {'123': {'get': {'operationId': 'swagger_aggregator.string'}},
-                                                 '789': {'delete': {'operationId': 'swagger_aggregator.string'}}}},
-                                      default_flow_style=False)
+                                       'paths': {'123': {'get': {'operationId': 'swagger_aggregator.operations.get_123'}},
+                                                 '789': {'delete': {'operationId': 'swagger_aggregator.operations.delete_789'}}}},
+                                      Dumper=YamlDumper, default_flow_style=False)
+
+
+def test_generate_swagger_json_validation(mocker, yaml_file, tmpdir):
+    yaml_file['output'] = {'format': 'json'}
+    config_file = str(tmpdir.join('config.yaml'))
+    with open(config_file, 'w') as f:
+        f.write(yaml.dump(yaml_file))
+    agg = SwaggerAggregator(config_file, 'trax', 'air')
+
+    spec = {
+        'paths': {'/identifications/{id}': {'get': {
+            'parameters': [{'name': 'id', 'in': 'path', 'type': 'string', 'required': True}],
+            'responses': {'200': {'description': 'Test', 'schema': {'$ref': '#/definitions/Test'}}}}}},
+        'definitions': {'Test': {'type': 'object', 'properties': {'sub': {'$ref': '#/definitions/Sub'}}},
+                        'Sub': {'type': 'object'}}
+    }
+    agg.get_aggregate_swagger = lambda: {'identifications': {'spec': spec, 'url': 'http://trax/v1'}}
+    agg.generate_swagger_json()
+
+    # The annotations of the validator are not published
+    with open(str(tmpdir.join('swagger.json'))) as f:
+        assert 'x-scope' not in f.read()
+    assert b'x-scope' not in agg.get_serialized_swagger().body
+    assert agg.swagger_parser.get_dict_definition({'sub': {}}) == 'identificationsTest'
+
+
+def test_generate_swagger_json_exclude_fields(mocker, yaml_file):
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    mock_yaml = mocker.patch('swagger_aggregator.swagger_aggregator.yaml.dump')
+    mocker.patch('swagger_aggregator.swagger_aggregator.write_file_atomic')
+    mock_parser = mocker.patch('swagger_aggregator.swagger_aggregator.SwaggerParser')
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air')
+    agg.exclude_paths = lambda swagger: swagger
+
+    test_definition = {'required': ['id', 'test'], 'properties': {'id': {'type': 'string'}, 'test': {'type': 'string'}}}
+    aggregate = {'identifications': {'spec': {'paths': {}, 'definitions': {'Test': test_definition}},
+                                     'url': 'http://trax/v1'}}
+    agg.get_aggregate_swagger = lambda: aggregate
+
+    agg.generate_swagger_json()
+
+    assert mock_yaml.call_args[0][0]['definitions'] == {
+        'identificationsTest': {'required': ['test'], 'properties': {'test': {'type': 'string'}}}}
+    assert mock_parser.call_args[1]['swagger_dict']['definitions'] == {'identificationsTest': test_definition}
+    assert aggregate['identifications']['spec']['definitions']['Test'] == test_definition
+
+
+def test_update_api(mocker, yaml_file):
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    mock_yaml = mocker.patch('swagger_aggregator.swagger_aggregator.yaml.dump')
+    mocker.patch('swagger_aggregator.swagger_aggregator.write_file_atomic')
+    mock_parser = mocker.patch('swagger_aggregator.swagger_aggregator.SwaggerParser')
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air')
+
+    agg.swagger_apis = {
+        'identifications': {'spec': {'paths': {'/identifications': {'get': {}, 'post': {}}},
+                                     'definitions': {'Test': {}}},
+                            'url': 'http://trax/v1'},
+        'ingestion': {'spec': {'paths': {'/ingestions/sources': {'get': {}}}, 'definitions': {'Test': {}}},
+                      'url': 'http://air/v1'}
+    }
+    agg.get_aggregate_swagger = lambda: agg.swagger_apis
+    agg.generate_swagger_json()
+
+    assert agg.operations[('/identifications', 'post')].name == 'post_identifications'
+    assert agg.operations[('/ingestions/sources', 'get')].name == 'get_ingestions_sources'
+    ingestion_func = operations.get_ingestions_sources
+
+    agg.update_api('identifications', {'paths': {'/identifications': {'get': {}},
+                                                 '/identifications/{id}': {'get': {}}},
+                                       'definitions': {'Other': {}}})
+
+    assert not hasattr(operations, 'post_identifications')
+    assert operations.get_ingestions_sources is ingestion_func
+    assert sorted(agg.operations.keys()) == [('/identifications', 'get'), ('/identifications/{id}', 'get'),
+                                             ('/ingestions/sources', 'get')]
+    assert sorted(operations.functions.keys()) == ['get_identifications', 'get_identifications_id',
+                                                   'get_ingestions_sources']
+    assert agg.swagger['paths']['/identifications/{id}']['get']['operationId'] == \
+        'swagger_aggregator.operations.get_identifications_id'
+    assert mock_yaml.call_count == 2
+    assert sorted(json.loads(agg.get_serialized_swagger().body.decode('utf-8'))['paths'].keys()) == [
+        '/identifications', '/identifications/{id}', '/ingestions/sources']
+
+    # The parser is not rebuilt, only the examples of the api definitions are
+    assert mock_parser.call_count == 1
+    assert sorted(c[0][0] for c in mock_parser.return_value.definitions_example.pop.call_args_list) == [
+        'identificationsOther', 'identificationsTest']
+    mock_parser.return_value.build_one_definition_example.assert_called_once_with('identificationsOther')
+
+    # Regeneration releases the previous generation
+    agg.generate_swagger_json()
+    assert operations.get_ingestions_sources is not ingestion_func
+    assert len(operations.functions) == 3
+    assert agg.operation_index[('/identifications/{id}', 'get')][1:] == ('http://trax/v1', 'identifications')
+    assert sorted(agg.swagger['definitions'].keys()) == ['identificationsOther', 'ingestionTest']
+    assert sorted(agg.swagger['paths'].keys()) == ['/identifications', '/identifications/{id}', '/ingestions/sources']
+
+
+def test_write_file_atomic(tmpdir):
+    path = str(tmpdir.join('swagger.yaml'))
+    with open(str(tmpdir.join('reference')), 'w'):
+        pass
+    write_file_atomic(path, b'old')
+    write_file_atomic(path, b'new')
+    assert stat.S_IMODE(os.stat(path).st_mode) == stat.S_IMODE(os.stat(str(tmpdir.join('reference'))).st_mode)
+    os.remove(str(tmpdir.join('reference')))
+
+    write_file_atomic(path, b'private', 0o600)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+    with open(path, 'rb') as f:
+        assert f.read() == b'private'
+    assert tmpdir.listdir() == [tmpdir.join('swagger.yaml')]
+
+
+def test_write_swagger(mocker, yaml_file, tmpdir):
+    config_file = str(tmpdir.join('config.yaml'))
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    write_file_atomic = mocker.patch('swagger_aggregator.swagger_aggregator.write_file_atomic')
+    agg = SwaggerAggregator(config_file, 'trax', 'air')
+    swagger = {'swagger': '2.0', 'paths': {'/test': {'get': {}}}}
+
+    agg.write_swagger(swagger)
+    assert write_file_atomic.call_args[0][0] == str(tmpdir.join('swagger.yaml'))
+    assert yaml.SafeLoader(write_file_atomic.call_args[0][1]).get_single_data() == swagger
+
+    yaml_file['output'] = {'format': 'json', 'minify': True}
+    agg.write_swagger(swagger)
+    assert write_file_atomic.call_args[0] == (str(tmpdir.join('swagger.json')),
+                                              b'{"swagger":"2.0","paths":{"/test":{"get":{}}}}')
+
+    yaml_file['output'] = {'format': 'json', 'gzip': True, 'path': str(tmpdir.join('out.json'))}
+    agg.write_swagger(swagger)
+    assert write_file_atomic.call_args[0][0] == str(tmpdir.join('out.json.gz'))
+    with gzip.GzipFile(fileobj=io.BytesIO(write_file_atomic.call_args[0][1])) as f:
+        assert json.loads(f.read().decode('utf-8')) == swagger
+
+    yaml_file['output'] = False
+    agg.write_swagger(swagger)
+    assert write_file_atomic.call_count == 3
+
+
+def test_serve_swagger_json(mocker, yaml_file):
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air')
+    agg.swagger = {'swagger': '2.0', 'paths': {'/test': {'get': {}}}}
+    serialize = mocker.spy(SerializedSwagger, '__init__')
+    agg.serialized_swagger = SerializedSwagger(agg.swagger)
+
+    app = flask.Flask(__name__)
+    agg.register_swagger_json(app)
+    client = app.test_client()
+
+    response = client.get('/swagger.json')
+    assert response.status_code == 200
+    assert json.loads(response.data.decode('utf-8')) == agg.swagger
+    etag = response.headers['ETag']
+
+    response = client.get('/swagger.json', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    with gzip.GzipFile(fileobj=io.BytesIO(response.data)) as f:
+        assert json.loads(f.read().decode('utf-8')) == agg.swagger
+
+    response = client.get('/swagger.json', headers={'Accept-Encoding': 'gzip;q=0', 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert serialize.call_count == 1
+
+    # A new generation is served
+    agg.swagger = {'swagger': '2.0', 'paths': {}}
+    agg.serialized_swagger = SerializedSwagger(agg.swagger)
+    response = client.get('/swagger.json', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_cache(mocker, yaml_file, tmpdir):
+    config_file = str(tmpdir.join('config.yaml'))
+    with open(config_file, 'w') as f:
+        f.write(yaml.dump(yaml_file))
+    cache_dir = str(tmpdir.join('cache'))
+    mock_parser = mocker.patch('swagger_aggregator.swagger_aggregator.SwaggerParser')
+    mock_request = mocker.patch('swagger_aggregator.swagger_aggregator.requests')
+
+    specs = {
+        'http://trax/v1/swagger.json': b'{"paths": {"/identifications/{id}": {"get": {}}}, "definitions": {"Test": {}}}',
+        'http://air/v1/swagger.json': b'{"paths": {"/ingestions/{id}": {"get": {}}}, "definitions": {"Test": {}}}'
+    }
+
+    def get(url, **kwargs):
+        req = MagicMock()
+        req.status_code = 200
+        req.content = specs[url]
+        req.headers = {}
+        req.json.return_value = json.loads(specs[url].decode('utf-8'))
+        return req
+    mock_request.get.side_effect = get
+
+    agg = SwaggerAggregator(config_file, 'trax', 'air', cache_dir=cache_dir)
+    agg.generate_swagger_json()
+    assert len(tmpdir.join('cache').listdir()) == 3
+
+    # Warm start with the microservices down
+    mock_request.get.side_effect = RequestException('down')
+    merge_aggregates = mocker.spy(SwaggerAggregator, 'merge_aggregates')
+
+    warm_agg = SwaggerAggregator(config_file, 'trax', 'air', cache_dir=cache_dir)
+    assert sorted(warm_agg.load_cache()) == ['identifications', 'ingestion']
+    warm_agg.generate_swagger_json()
+
+    assert merge_aggregates.call_count == 0
+    assert mock_parser.call_count == 1  # The cached aggregate is not validated again
+    assert warm_agg.swagger_parser.get_dict_definition({}) in ('identificationsTest', 'ingestionTest')
+    assert warm_agg.errors == []
+    assert sorted(warm_agg.swagger['paths'].keys()) == ['/identifications/{id}', '/ingestions/{id}']
+    assert warm_agg.get_spec_from_uri('/ingestions/{id}', 'get')[1] == 'http://air/v1'
+
+    # Cached swaggers are used when the microservices are down
+    cold_agg = SwaggerAggregator(config_file, 'trax', 'air', cache_dir=cache_dir)
+    assert sorted(cold_agg.get_aggregate_swagger().keys()) == ['identifications', 'ingestion']
+    assert sorted(cold_agg.errors) == ['http://identifications_url/v1', 'http://ingestion_url/v1']
+
+
+def test_generate_operation_id_function_metrics(mocker, yaml_file):
+    try:
+        mocker.patch('__builtin__.open', create=True)
+    except Exception:  # Python3
+        mocker.patch('builtins.open', create=True)
+    mocker.patch('swagger_aggregator.swagger_aggregator.yaml.load', return_value=yaml_file)
+    events = []
+    agg = SwaggerAggregator('config.yaml', 'trax', 'air',
+                            metrics=CallbackSink(lambda event, operation, **fields: events.append((event, fields))))
+
+    mock_request = mocker.patch('swagger_aggregator.swagger_aggregator.requests')
+    mock_request.Session.return_value.get.side_effect = [ConnectionError('down'), MagicMock(status_code=200)]
+    flask_mock = mocker.patch('swagger_aggregator.swagger_aggregator.flask')
+    flask_mock.request.query_string = ''
+    flask_mock.request.headers = {}
+    mocker.patch('swagger_aggregator.swagger_aggregator.time.sleep')
+    mocker.patch('swagger_aggregator.swagger_aggregator.SwaggerAggregator.stream_response')
+
+    func = agg.generate_operation_id_function(Operation('func_name', '/path/', 'get', 'identifications', 'url', {}))
+    func()
+
+    assert func.__name__ == 'func_name'
+    assert [event for event in events if event[0] != 'phase'] == [('retry', {}), ('status', {'status_code': 200})]
+    assert [fields['phase'] for event, fields in events if event == 'phase'] == ['url', 'upstream', 'total']